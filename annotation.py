@@ -4,8 +4,11 @@
 import os
 import json
 import uuid
-from PyQt6.QtCore import QSize, Qt, QRect, QPoint, pyqtSignal, pyqtSlot 
-from PyQt6.QtGui import QAction, QIcon, QPixmap, QImage, QPainter, QPen, QColor, QFontMetrics, QPolygon
+import numpy as np
+from instrumentation import timed
+from annotation_store import AnnotationStore
+from PyQt6.QtCore import QSize, Qt, QRect, QRectF, QPoint, QPointF, pyqtSignal, pyqtSlot 
+from PyQt6.QtGui import QAction, QIcon, QPixmap, QImage, QPainter, QPen, QColor, QFontMetrics, QPolygon, QTransform, QMouseEvent
 from PyQt6.QtWidgets import (QDialog, QFileDialog, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QToolButton,
     QVBoxLayout, QWidget, QSizePolicy, QStatusBar, QDialogButtonBox, QPushButton, QColorDialog, QComboBox, QMessageBox)
 
@@ -223,22 +226,124 @@ class LabelEditDialog(QDialog):
 
 #   Paint layer for painting
 
+class PaintTile:
+
+    #   One Alpha8 buffer seen three ways without copies: QPainter draws into the QImage, mask is a
+    #   uint8 coverage (0-255) NumPy view on its pixels and view is an Indexed8 QImage on the same
+    #   pixels whose color table turns coverage into the layer color
+    __slots__ = ('image', 'bits', 'mask', 'view')
+
+    def __init__(self, size, colorTable):
+        self.image = QImage(size, size, QImage.Format.Format_Alpha8)
+        self.image.fill(0)
+        self.bits = self.image.bits()
+        self.bits.setsize(self.image.sizeInBytes())
+        stride = self.image.bytesPerLine()
+        self.mask = np.frombuffer(self.bits, np.uint8).reshape(size, stride)[:, :size]
+        self.view = QImage(self.bits, size, size, stride, QImage.Format.Format_Indexed8)
+        self.view.setColorTable(colorTable)
+
 class PaintLayer:
+
+    #   Strokes live in tileSize x tileSize PaintTiles that are allocated where a stroke touches
+    #   them and freed once erased back to zero, keyed by (column, row) of the tile
+
+    tileSize = 64
+    brushSize = 20
+
     def __init__(self, label, color):
         self.id = str(uuid.uuid4())
         self.label = label
         self.color = color
-        self.pixmap = QPixmap()
+        self.colorTable = self.makeColorTable(color)
+        self.size = QSize()
+        self.tiles = {}
+
+    @staticmethod
+    def makeColorTable(color):
+        #   Index = coverage, entry = the color with that alpha
+        rgb = QColor(color).rgb() & 0xFFFFFF
+        return [alpha << 24 | rgb for alpha in range(256)]
 
     def initialize(self, size):
-        self.pixmap = QPixmap(size)
-        self.pixmap.fill(Qt.GlobalColor.transparent)
+        self.size = QSize(size)
+        self.tiles.clear()
+
+    def tileRange(self, x1, y1, x2, y2, width):
+        #   Tiles a segment drawn with a pen of this width can touch, clipped to the layer
+        size, reach = self.tileSize, width // 2 + 1
+        columns = -(-self.size.width() // size)
+        rows = -(-self.size.height() // size)
+        for tx in range(max(0, (min(x1, x2) - reach) // size), min(columns, (max(x1, x2) + reach) // size + 1)):
+            for ty in range(max(0, (min(y1, y2) - reach) // size), min(rows, (max(y1, y2) + reach) // size + 1)):
+                yield tx, ty
+
+    def stroke(self, x1, y1, x2, y2, erase=False):
+        #   The eraser is a little wider than the brush so it also takes the antialiased rim
+        size = self.tileSize
+        width = self.brushSize + 4 if erase else self.brushSize
+        pen = QPen(QColor(Qt.GlobalColor.black), width)
+        pen.setCapStyle(Qt.PenCapStyle.RoundCap)
+        pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
+        for tile in self.tileRange(x1, y1, x2, y2, width):
+            paintTile = self.tiles.get(tile)
+            if paintTile is None:
+                if erase:
+                    continue
+                paintTile = self.tiles[tile] = PaintTile(size, self.colorTable)
+
+            painter = QPainter(paintTile.image)
+            try:
+                painter.setPen(pen)
+                painter.setRenderHint(QPainter.RenderHint.Antialiasing)
+                painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Clear if erase else
+                                           QPainter.CompositionMode.CompositionMode_SourceOver)
+                painter.translate(-tile[0] * size, -tile[1] * size)
+                painter.drawLine(x1, y1, x2, y2)
+            finally:
+                painter.end()
+            if erase and not paintTile.mask.any():
+                del self.tiles[tile]
+
+    def recolor(self, color):
+        #   Only the color table changes, no pixel is touched
+        self.color = color
+        self.colorTable = self.makeColorTable(color)
+        for paintTile in self.tiles.values():
+            paintTile.view.setColorTable(self.colorTable)
+
+    def draw(self, painter):
+        size = self.tileSize
+        for (tx, ty), paintTile in self.tiles.items():
+            painter.drawImage(tx * size, ty * size, paintTile.view)
+
+    def toMask(self):
+        #   Painted pixels (coverage > 0) at layer size, only allocated tiles are read
+        rows, cols = self.size.height(), self.size.width()
+        mask = np.zeros((rows, cols), dtype=bool)
+        size = self.tileSize
+        for (tx, ty), paintTile in self.tiles.items():
+            x, y = tx * size, ty * size
+            coverage = paintTile.mask[:rows - y, :cols - x]
+            mask[y:y + coverage.shape[0], x:x + coverage.shape[1]] = coverage > 0
+        return mask
+
+    def clear(self):
+        self.tiles.clear()
+
+    @property
+    def nbytes(self):
+        return sum(paintTile.image.sizeInBytes() for paintTile in self.tiles.values())
 
 #   Annotatable image display
 
 class AnnotatableImageDisplay(QLabel):
 
     labelColorChanged = pyqtSignal(str)
+    sliceStepped = pyqtSignal(int)
+    roiSelected = pyqtSignal(int, int, int, int)
+    viewChanged = pyqtSignal()
+    paintChanged = pyqtSignal()
 
     def __init__(self, parent = None):
         super().__init__(parent)
@@ -248,10 +353,10 @@ class AnnotatableImageDisplay(QLabel):
         self.endPoint = None
         self.drawing = False
         self.image = None
-        self.annotations = []   #   Stores label, colors and bounding box coordinates for saving
+        self.store = AnnotationStore()   #   Rectangles and polygons with their labels and colors, for drawing and saving
+        self.polygonId = None            #   Polygon still getting points
         self.mode = 'Select'
         self.shape = 'rectangle'
-        self.polygonPoints = []
         self.currentRectangle = None
         self.labelDialog = LabelEditDialog(self)
         self.lastX = None
@@ -260,9 +365,27 @@ class AnnotatableImageDisplay(QLabel):
         self.newY = None
         self.paintLayers = []
         self.currentPaintLayer = None
-        self.selectedRectangle = None
-        self.polygonSelected = False
+        self.erasing = False
+        self.selectedShape = None
         self.isEmpty = True
+        self.roiMode = False
+        self.roiPreviousShape = None
+        self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
+
+        #   Zoom & pan: annotations stay in base coordinates (the unzoomed label, what DicomSaver.tr
+        #   maps to raw pixels), the view is zoom plus the base position of its top-left corner
+        self.zoom = 1.0
+        self.maxZoom = 16.0
+        self.offset = QPointF(0, 0)
+        self.panStart = None
+        self.tiles = None
+
+        #   Base coordinates are baseSize pixels wide whatever the widget size, so the label can be
+        #   resized (multi-viewport layouts) without moving annotations. Mirrors are extra viewports
+        #   that draw this display's annotations and hand their input to it
+        self.baseSize = None
+        self.source = None
+        self.mirrors = []
 
     def resizeEvent(self, event):
         #   Makes image placeholder square
@@ -270,130 +393,217 @@ class AnnotatableImageDisplay(QLabel):
         self.setFixedSize(QSize(size, size))
         super().resizeEvent(event)
 
+    def wheelEvent(self, event):
+        #   Ctrl + wheel zooms around the cursor, the wheel alone scrolls through the slices of a series
+        delta = event.angleDelta().y()
+        if not delta:
+            return
+        if self.source is not None:
+            target, anchor = self.source, self.toSource(event.position())
+        else:
+            target, anchor = self, event.position()
+        if event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+            target.setZoom(target.zoom * 1.25 ** (delta / 120), anchor)
+        else:
+            target.sliceStepped.emit(-1 if delta > 0 else 1)
+
+    def keyPressEvent(self, event):
+        if self.source is not None:
+            self.source.keyPressEvent(event)
+        elif event.key() in (Qt.Key.Key_Up, Qt.Key.Key_PageUp):
+            self.sliceStepped.emit(-1)
+        elif event.key() in (Qt.Key.Key_Down, Qt.Key.Key_PageDown):
+            self.sliceStepped.emit(1)
+        elif event.key() in (Qt.Key.Key_Plus, Qt.Key.Key_Equal):
+            self.setZoom(self.zoom * 1.25)
+        elif event.key() == Qt.Key.Key_Minus:
+            self.setZoom(self.zoom / 1.25)
+        elif event.key() == Qt.Key.Key_0:
+            self.setZoom(1.0)
+        else:
+            super().keyPressEvent(event)
+
+    def baseSide(self):
+        if self.source is not None:
+            return self.source.baseSide()
+        return self.baseSize or self.width()
+
+    def viewScale(self):
+        #   Widget pixels per base pixel
+        return self.zoom * self.width() / self.baseSide()
+
+    def toBase(self, point):
+        scale = self.viewScale()
+        return QPoint(int(point.x() / scale + self.offset.x()), int(point.y() / scale + self.offset.y()))
+
+    def toSource(self, point):
+        #   Mirror widget position -> the same base point in the source display's widget
+        scale, sourceScale = self.viewScale(), self.source.viewScale()
+        return QPointF((point.x() / scale + self.offset.x() - self.source.offset.x()) * sourceScale,
+                       (point.y() / scale + self.offset.y() - self.source.offset.y()) * sourceScale)
+
+    def linkTo(self, source):
+        self.source = source
+        source.mirrors.append(self)
+        self.syncView(source)
+
+    def unlink(self):
+        if self.source is not None and self not in self.source.mirrors:
+            return
+        if self.source is not None:
+            self.source.mirrors.remove(self)
+        self.source = None
+
+    def syncView(self, source):
+        self.zoom = source.zoom
+        self.offset = QPointF(source.offset)
+        self.update()
+        self.viewChanged.emit()
+
+    def setZoom(self, zoom, anchor=None):
+        #   The base point under anchor (the centre by default) stays where it is
+        if self.pixmap() is None or self.pixmap().isNull():
+            return
+        zoom = max(1.0, min(zoom, self.maxZoom))
+        if anchor is None:
+            anchor = QPointF(self.width() / 2, self.height() / 2)
+        scale = self.viewScale()
+        base = QPointF(anchor.x() / scale + self.offset.x(), anchor.y() / scale + self.offset.y())
+        self.zoom = zoom
+        scale = self.viewScale()
+        self.panTo(QPointF(base.x() - anchor.x() / scale, base.y() - anchor.y() / scale))
+
+    def panTo(self, offset):
+        side = self.baseSide()
+        x = max(0.0, min(offset.x(), side - side / self.zoom))
+        y = max(0.0, min(offset.y(), side - side / self.zoom))
+        self.offset = QPointF(x, y)
+        self.update()
+        self.viewChanged.emit()
+        for mirror in self.mirrors:
+            mirror.syncView(self)
+
+    def resetView(self):
+        self.zoom = 1.0
+        self.offset = QPointF(0, 0)
+        self.tiles = None
+        self.update()
+        for mirror in self.mirrors:
+            mirror.resetView()
+
+    def viewRegion(self):
+        #   (zoom, visible part as fractions of the image) for the tile renderer, None when not zoomed
+        if self.zoom == 1:
+            return None
+        side = self.baseSide()
+        x, y = self.offset.x(), self.offset.y()
+        return self.zoom, (x / side, y / side, (x + side / self.zoom) / side, (y + side / self.zoom) / side)
+
+    def forwardMouse(self, event, handler):
+        position = self.toSource(event.position())
+        handler(QMouseEvent(event.type(), position, event.globalPosition(), event.button(),
+                            event.buttons(), event.modifiers()))
+
+    def setTiles(self, tiles):
+        #   tiles: (level shape, [(x, y, uint8 pixels)]) from DicomLoader.renderTiles, or None
+        self.tiles = tiles
+        self.update()
+
     def mousePressEvent(self, event):
+        #   Middle button pans, everything else works in base coordinates
+        if self.source is not None:
+            self.forwardMouse(event, self.source.mousePressEvent)
+            return
+        if event.button() == Qt.MouseButton.MiddleButton:
+            self.panStart = event.position()
+            return
+        pos = self.toBase(event.pos())
 
         if event.button() == Qt.MouseButton.LeftButton:
             if self.mode == 'Annotate':
                 if self.shape == 'rectangle':
-                    self.startPoint = self.constrainPoint(event.pos())
+                    self.startPoint = self.constrainPoint(pos)
                     self.endPoint = self.startPoint
                     self.drawing = True
                     self.currentRectangle = (self.startPoint, self.endPoint)
 
                 elif self.shape == 'polygon':
-                    self.addPoint2Polygon(event.pos())
+                    self.addPoint2Polygon(pos)
 
                 elif self.shape == 'paint':
                     self.drawing = True
-                    self.tempPixmap = QPixmap(self.size())
-                    self.tempPixmap.fill(Qt.GlobalColor.transparent)
 
             elif self.mode == 'Select':
-                if self.shape == 'rectangle':
-                    self.dragStartX = event.pos().x()
-                    self.dragStartY = event.pos().y()
-                    for annotation in self.annotations:
-                        x1, y1, x2, y2 = annotation['bbox']
-                        if x1 > x2:
-                            x1, x2 = x2, x1
-                        if y1 > y2:
-                            y1, y2 = y2, y1
-                        if x1 <= event.pos().x() <= x2:
-                            if y1 <= event.pos().y() <= y2:
-                                self.selectedRectangle = annotation['label']
-                                break
-                elif self.shape == 'polygon':
-                    self.dragStartX = event.pos().x()
-                    self.dragStartY = event.pos().y()
-                    xPoints = []
-                    yPoints = []
-                    for point in self.polygonPoints:
-                        x = point.x()
-                        y = point.y()
-                        xPoints.append(x)
-                        yPoints.append(y)
-                    if min(xPoints) <= event.pos().x() <= max(xPoints):
-                        if min(yPoints) <= event.pos().y() <= max(yPoints):
-                            self.polygonSelected = True
+                if self.shape in AnnotationStore.kinds:
+                    self.dragStartX = pos.x()
+                    self.dragStartY = pos.y()
+                    self.selectedShape = self.store.hit(self.shape, pos.x(), pos.y())
 
         if event.button() == Qt.MouseButton.RightButton:
             if self.shape == 'polygon':
                 self.clearPolygon()
             elif self.shape == 'rectangle':
                 self.clearRectangle()
+            elif self.shape == 'paint' and self.currentPaintLayer is not None:
+                #   Right drag erases from the current brush label
+                self.erasing = True
 
 
 
     def mouseMoveEvent(self, event):
-        if self.drawing:
-            if self.shape == 'rectangle':
-                self.endPoint = self.constrainPoint(event.pos())
-                self.currentRectangle = (self.startPoint, self.endPoint)
-                self.update()
+        if self.source is not None:
+            self.forwardMouse(event, self.source.mouseMoveEvent)
+            return
+        if self.panStart is not None:
+            delta = event.position() - self.panStart
+            self.panStart = event.position()
+            self.panTo(self.offset - delta / self.zoom)
+            return
+        pos = self.toBase(event.pos())
+
+        if self.drawing and self.shape == 'rectangle':
+            self.endPoint = self.constrainPoint(pos)
+            self.currentRectangle = (self.startPoint, self.endPoint)
+            self.update()
 
-            elif self.shape == 'paint':
-                if self.lastX is None:
-                    self.lastX, self.lastY = event.pos().x(), event.pos().y()
-                    return
+        if (self.drawing and self.shape == 'paint') or self.erasing:
+            if self.lastX is None:
+                self.lastX, self.lastY = pos.x(), pos.y()
+                return
 
-                self.newX, self.newY = event.pos().x(), event.pos().y()
-                
-                painter = QPainter(self.currentPaintLayer.pixmap)
-                try:
-                    pen = QPen(self.currentPaintLayer.color, 20)
-                    pen.setCapStyle(Qt.PenCapStyle.RoundCap)
-                    pen.setJoinStyle(Qt.PenJoinStyle.RoundJoin)
-                    painter.setPen(pen)
-                    painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-                    painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_SourceOver)
-                    painter.drawLine(self.lastX, self.lastY, self.newX, self.newY)
-                finally:
-                    painter.end()
-
-                self.lastX, self.lastY = self.newX, self.newY
-                self.update()           
-
-        if self.mode == 'Select':
-            if self.shape == 'rectangle':
-                if self.selectedRectangle is not None:
-                    for annotation in self.annotations:
-                        if annotation['label'] == self.selectedRectangle:
-                            draggingX, draggingY = event.pos().x(), event.pos().y()
-                            diffX, diffY = self.dragStartX - draggingX, self.dragStartY - draggingY
-                            x1, y1, x2, y2 = annotation['bbox']
-                            if x1 > x2:
-                                x1, x2 = x2, x1
-                            if y1 > y2:
-                                y1, y2 = y2, y1
-                            if 0 < x1 - diffX < self.width()  and 0 < x2 - diffX < self.width():
-                                if 0 < y1 - diffY < self.height()  and 0 < y2 - diffY < self.height():
-                                    annotation['bbox'] = x1 - diffX, y1 - diffY, x2 - diffX, y2 - diffY
-                            self.dragStartX = draggingX
-                            self.dragStartY = draggingY
-                            self.update()
-
-            elif self.shape == 'polygon':
-                if self.polygonSelected:
-                    newPointList = []
-                    draggingX, draggingY = event.pos().x(), event.pos().y()
-                    for point in self.polygonPoints:
-                        x = point.x()
-                        y = point.y()
-                        diffX, diffY = self.dragStartX - draggingX, self.dragStartY - draggingY
-                        x = x - diffX
-                        y = y - diffY
-                        point = QPoint(x, y)
-                        newPointList.append(point)
-                    self.polygonPoints.clear()
-                    self.polygonPoints = newPointList
-                    self.dragStartX = draggingX
-                    self.dragStartY = draggingY
-                    self.update()
+            self.newX, self.newY = pos.x(), pos.y()
+            self.currentPaintLayer.stroke(self.lastX, self.lastY, self.newX, self.newY, erase=self.erasing)
+            self.lastX, self.lastY = self.newX, self.newY
+            self.update()
+
+        if self.mode == 'Select' and self.selectedShape is not None:
+            #   Rectangles stay inside the image, polygons move freely
+            draggingX, draggingY = pos.x(), pos.y()
+            diffX, diffY = draggingX - self.dragStartX, draggingY - self.dragStartY
+            x1, y1, x2, y2 = self.selectedShape.bbox
+            side = self.baseSide()
+            if self.selectedShape.kind == 'polygon' or (0 < x1 + diffX and x2 + diffX < side and
+                                                        0 < y1 + diffY and y2 + diffY < side):
+                self.store.move(self.selectedShape.id, diffX, diffY)
+            self.dragStartX = draggingX
+            self.dragStartY = draggingY
+            self.update()
 
 
     def mouseReleaseEvent(self, event):
-        self.selectedRectangle = None
-        self.polygonSelected = False
+        if self.source is not None:
+            self.forwardMouse(event, self.source.mouseReleaseEvent)
+            return
+        if event.button() == Qt.MouseButton.MiddleButton:
+            self.panStart = None
+            return
+        self.selectedShape = None
+        if event.button() == Qt.MouseButton.RightButton and self.erasing:
+            self.erasing = False
+            self.lastX = None
+            self.lastY = None
+            self.paintChanged.emit()
+            return
         if event.button() == Qt.MouseButton.LeftButton and self.drawing and self.mode == 'Annotate':
             # self.endPoint = self.constrainPoint(event.pos())
             if self.shape != 'paint':
@@ -405,31 +615,21 @@ class AnnotatableImageDisplay(QLabel):
                 self.newX = None
                 self.newY = None
                 self.drawing = False
-
-                # Merge tempPixmap with the main image or annotations
-                if not hasattr(self, 'paintAnnotations'):
-                    self.paintAnnotations = QPixmap(self.size())
-                    self.paintAnnotations.fill(Qt.GlobalColor.transparent)
-                
-                if hasattr(self, 'tempPixmap') and self.tempPixmap is not None:
-                    painter = QPainter(self.paintAnnotations)
-                    painter.setOpacity(0.4)
-                    painter.drawPixmap(0, 0, self.tempPixmap)
-                    painter.end()
-                
-                self.tempPixmap = None
+                self.paintChanged.emit()
             
             # Finalize the rectangle
-            if self.startPoint and self.endPoint:
+            if self.startPoint and self.endPoint and self.roiMode:
+                #   Windowing ROI: handed to the main window, never stored as an annotation
+                self.roiSelected.emit(self.startPoint.x(), self.startPoint.y(), self.endPoint.x(), self.endPoint.y())
+                self.roiMode = False
+                self.shape = self.roiPreviousShape
+
+            elif self.startPoint and self.endPoint:
                 if self.shape == 'rectangle':
                     x1, y1 = self.startPoint.x(), self.startPoint.y()
                     x2, y2 = self.endPoint.x(), self.endPoint.y()
 
-                    self.annotations.append({
-                        'label': self.currentLabelName,
-                        'color': self.currentLabelColor.name(),
-                        'bbox': (x1, y1, x2, y2)
-                    })
+                    self.store.add('rectangle', self.currentLabelName, self.currentLabelColor.name(), ((x1, y1), (x2, y2)))
 
             # Clear temporary rectangle
             self.startPoint = None
@@ -444,26 +644,30 @@ class AnnotatableImageDisplay(QLabel):
         self.currentLabelName = labelName
         self.currentLabelColor = color
 
+    def paintMemory(self):
+        #   (label, bytes, tiles) of every paint layer
+        return [(layer.label, layer.nbytes, len(layer.tiles)) for layer in self.paintLayers]
+
     def constrainPoint(self, point):
         if self.image:
             x = max(0, min(point.x(), self.image.width() - 2))
             y = max(0, min(point.y(), self.image.height() - 1))
         else:
-            x = max(0, min(point.x(), self.width() - 1))
-            y = max(0, min(point.y(), self.height() - 1))
+            x = max(0, min(point.x(), self.baseSide() - 1))
+            y = max(0, min(point.y(), self.baseSide() - 1))
 
         return QPoint(x, y)
 
     def createNewPaintLayer(self):
         newLayer = PaintLayer(self.currentLabelName, self.currentLabelColor)
-        newLayer.initialize(self.size())
+        newLayer.initialize(QSize(self.baseSide(), self.baseSide()))
         self.paintLayers.append(newLayer)
         self.currentPaintLayer = newLayer
 
     def setRectMode(self):
         self.mode = 'Annotate'
         self.shape = 'rectangle'
-        self.polygonPoints.clear()
+        self.finishPolygon()
         self.labelDialog.labelDataSelected.connect(self.setLabelData)
         self.labelDialog.exec() 
         self.update()
@@ -471,7 +675,7 @@ class AnnotatableImageDisplay(QLabel):
     def setPolygonMode(self):
         self.mode = 'Annotate'
         self.shape = 'polygon'
-        self.polygonPoints.clear()
+        self.finishPolygon()
         self.labelDialog.labelDataSelected.connect(self.setLabelData)
         self.labelDialog.exec() 
         self.update()
@@ -479,12 +683,21 @@ class AnnotatableImageDisplay(QLabel):
     def setPaintMode(self):
         self.mode = 'Annotate'
         self.shape = 'paint'
-        self.polygonPoints.clear()
+        self.finishPolygon()
         self.labelDialog.labelDataSelected.connect(self.setLabelData)
         self.labelDialog.exec() 
         self.createNewPaintLayer()
         self.update()
 
+    def setRoiMode(self):
+        #   Reuses the rectangle tool for one drag, the current shape comes back afterwards
+        if not self.roiMode:
+            self.roiPreviousShape = self.shape
+        self.roiMode = True
+        self.mode = 'Annotate'
+        self.shape = 'rectangle'
+        self.update()
+
     def setSelectionMode(self):
         self.mode = 'Select'
         self.update()
@@ -493,8 +706,8 @@ class AnnotatableImageDisplay(QLabel):
         self.isEmpty = True
         self.mode = 'Clear'
         self.currentRectangle = None
-        self.annotations.clear()
-        self.polygonPoints.clear()
+        self.store.clear()
+        self.polygonId = None
         self.paintLayers.clear()
         self.clearPainting()
         self.update()
@@ -508,46 +721,46 @@ class AnnotatableImageDisplay(QLabel):
         self.update()
 
     def addPoint2Polygon(self, point):
-        self.polygonPoints.append(point)
+        if self.polygonId is None:
+            self.polygonId = self.store.add('polygon', self.currentLabelName, self.currentLabelColor.name(),
+                                            ((point.x(), point.y()),)).id
+        else:
+            self.store.appendPoint(self.polygonId, point.x(), point.y())
         self.update()
 
+    def finishPolygon(self):
+        #   The next click starts a new polygon, one with fewer than three points is dropped
+        shape = self.store.get(self.polygonId)
+        if shape is not None and len(shape.points) < 3:
+            self.store.remove(shape.id)
+        self.polygonId = None
+
     def clearPolygon(self):
         self.isEmpty = True
-        self.polygonPoints.clear()
+        self.store.clear('polygon')
+        self.polygonId = None
         self.update()
 
     def clearRectangle(self):
         self.isEmpty = True
         self.currentRectangle = None
-        self.annotations.clear()
+        self.store.clear('rectangle')
         self.update()
 
     def clearPainting(self):
         self.isEmpty = True
-        if hasattr(self, 'paintAnnotations'):
-            self.paintAnnotations = QPixmap(self.size())
-            self.paintAnnotations.fill(Qt.GlobalColor.transparent)
-        
-        if hasattr(self, 'tempPixmap') and self.tempPixmap is not None:
-            self.tempPixmap.fill(Qt.GlobalColor.transparent)
-        
+        for layer in self.paintLayers:
+            layer.clear()
+        self.paintChanged.emit()
         self.update()
 
     def renameAnnotation(self, label2Remove, newLabel):
-        if self.shape == 'rectangle':
-            for annotation in self.annotations:
-                if annotation['label'] == label2Remove:
-                    annotation['label'] = newLabel
-                    if self.currentLabelName == annotation['label']:
-                        self.currentLabelName = newLabel
-
-                    break
-
-        elif self.shape == 'polygon':
+        #   Every rectangle and polygon with the label, not only the first one
+        self.store.rename(label2Remove, newLabel)
+        if self.currentLabelName == label2Remove:
             self.currentLabelName = newLabel
-            self.update()
 
-        elif self.shape == 'paint':
+        if self.shape == 'paint':
             for layer in self.paintLayers:
                 if layer.label == label2Remove:
                     layer.label = newLabel
@@ -558,55 +771,34 @@ class AnnotatableImageDisplay(QLabel):
         self.update()
 
     def removeAnnotation(self, label2Remove):
-        
-        for annotation in self.annotations:
-            if annotation['label'] == label2Remove:
-                self.annotations.remove(annotation)
-                break
-        
+        self.store.removeLabel(label2Remove, 'rectangle')
         self.update()
 
     def removePolyGs(self, label2Remove):
-        if self.shape == 'polygon':
-            if self.currentLabelName == label2Remove:
-                self.polygonPoints.clear()
-                self.update()
-        
+        self.store.removeLabel(label2Remove, 'polygon')
+        if self.polygonId not in self.store:
+            self.polygonId = None
         self.update()
 
     def removePainting(self, label2Remove):
         self.paintLayers = [layer for layer in self.paintLayers if layer.label != label2Remove]
+        if self.currentPaintLayer is not None and self.currentPaintLayer.label == label2Remove:
+            self.currentPaintLayer = None
+        self.paintChanged.emit()
         self.update()
 
 
-    def updatePaintAnnotationsColor(self, oldColor, newColor):
-        if hasattr(self, 'paintAnnotations') and self.paintAnnotations is not None:
-            image = self.paintAnnotations.toImage()
-            for x in range(image.width()):
-                for y in range(image.height()):
-                    if image.pixelColor(x, y).name() == oldColor.name():
-                        image.setPixelColor(x, y, newColor)
-            self.paintAnnotations = QPixmap.fromImage(image)
-
-    def updatePaintLayerColor(self, layer, oldColor, newColor):
-        image = layer.pixmap.toImage()
-        for x in range(image.width()):
-            for y in range(image.height()):
-                if image.pixelColor(x, y).name() == oldColor.name():
-                    image.setPixelColor(x, y, newColor)
-        layer.pixmap = QPixmap.fromImage(image)
-
     def recolorAnnotation(self, label2Recolor, card):
-        if self.shape == 'rectangle':
-            for annotation in self.annotations:
-                    if annotation['label'] == label2Recolor:
-                        originalColor = QColor(annotation['color'])
-                        color = QColorDialog.getColor(originalColor, self, 'Choose label color')
-                        if color.isValid():
-                            annotation['color'] = color.name()
-                            newColor = annotation['color'] 
-                            card.changeColorButton(newColor)
-                            self.update()
+        shapes = self.store.withLabel(label2Recolor)
+        if shapes:
+            originalColor = QColor(shapes[0].color)
+            color = QColorDialog.getColor(originalColor, self, 'Choose label color')
+            if color.isValid():
+                self.store.recolor(label2Recolor, color.name())
+                if self.currentLabelName == label2Recolor:
+                    self.currentLabelColor = color
+                card.changeColorButton(color.name())
+                self.update()
         elif self.shape in ['polygon', 'paint']:
             originalColor = self.currentLabelColor
             color = QColorDialog.getColor(originalColor, self, 'Choose label color')
@@ -618,102 +810,85 @@ class AnnotatableImageDisplay(QLabel):
                 if self.shape == 'paint':
                     for layer in self.paintLayers:
                         if layer.label == label2Recolor:
-                            originalColor = layer.color
                             if color.isValid():
-                                layer.color = color
+                                layer.recolor(color)
                                 card.changeColorButton(color.name())
-                                self.updatePaintLayerColor(layer, originalColor, color)
                 self.update()
 
+    @timed('paint')
     def paintEvent(self, event):
-        super().paintEvent(event)
+        if self.zoom == 1 and self.width() == self.baseSide():
+            super().paintEvent(event)
         self.isEmpty = False
         self.painter = QPainter(self)
         try:
-            if self.shape == 'rectangle':
-                #   Draw all rectangles
-                for annotation in self.annotations:
-                    label, color, bbox = annotation['label'], annotation['color'], annotation['bbox']
-                    rect = QRect(QPoint(bbox[0], bbox[1]), QPoint(bbox[2], bbox[3]))
-                    pen = QPen(QColor(color), 2, Qt.PenStyle.DashLine)
-                    self.painter.setPen(pen)
-
-                    #   Draw text labels
-                    fontMetrics = QFontMetrics(self.painter.font())
-                    textRect = fontMetrics.boundingRect(label)
-                    textX = rect.center().x() - textRect.width() // 2
-                    textY = rect.center().y() - textRect.height() // 2 
-                    self.painter.drawRect(rect)
-                    self.painter.setPen(pen)
-                    self.painter.drawText(QPoint(textX, textY + 10 ), label)
-
-                if self.currentRectangle:
-                    #   Current active rectangle
-                    start, end = self.currentRectangle
-                    pen = QPen(self.currentLabelColor, 2, Qt.PenStyle.DashLine)
-                    self.painter.setPen(pen)
-                    rect = QRect(start, end)
-                    self.painter.drawRect(rect)
-
-                    #   Draw text labels
-                    fontMetrics = QFontMetrics(self.painter.font())
-                    textRect = fontMetrics.boundingRect(self.currentLabelName)
-                    textX = rect.center().x() - textRect.width() // 2
-                    textY = rect.center().y() - textRect.height() // 2 
-                    self.painter.drawRect(rect)
-                    self.painter.setPen(pen)
-                    self.painter.drawText(QPoint(textX, textY + 10 ),self.currentLabelName)
-
-            elif self.shape == 'polygon':
-                if len(self.polygonPoints) >= 1 :
-                    for i in range(len(self.polygonPoints)):
-                        pen = QPen(self.currentLabelColor, 2, Qt.PenStyle.DashLine)
-                        self.painter.setPen(pen)
-                        point = self.polygonPoints[i]
-                        x, y = point.x(), point.y()
-                        self.painter.drawEllipse(x, y, 3, 3)
-                    if len(self.polygonPoints) >= 3 :
-                        pen = QPen(self.currentLabelColor, 2, Qt.PenStyle.DashLine)
-                        self.painter.setPen(pen)
-                        plg = QPolygon(self.polygonPoints)
-                        self.painter.drawPolygon(plg)
-                        self.painter.setPen(pen)
-                        boundingRect4Plg = plg.boundingRect()
-                        fontMetrics = QFontMetrics(self.painter.font())
-                        textRect = fontMetrics.boundingRect(self.currentLabelName)
-
-                        textX = boundingRect4Plg.center().x() - textRect.width() // 2
-                        textY = boundingRect4Plg.center().y() - textRect.height() // 2 
-                        self.painter.setPen(pen)
-                        self.painter.drawText(QPoint(textX, textY + 10),self.currentLabelName)
-
-            if hasattr(self, 'paintAnnotations'):
-                # Draw all paint layers
-                for layer in self.paintLayers:
-                    self.painter.setOpacity(0.4)
-                    self.painter.drawPixmap(0, 0, layer.pixmap)
-                    
-                    # Draw label for each layer
-                    pen = QPen(layer.color, 2, Qt.PenStyle.DashLine)
-                    self.painter.setPen(pen)
-                    # boundingRect = layer.pixmap.rect()
-                    # textX = boundingRect.center().x()
-                    # textY = boundingRect.center().y() 
-                    # self.painter.drawText(QPoint(textX, textY + 10), layer.label)
-
-            if hasattr(self, 'tempPixmap') and self.tempPixmap is not None:
-                # Draw all paint layers
-                for layer in self.paintLayers:
-                    self.painter.setOpacity(0.4)
-                    self.painter.drawPixmap(0, 0, layer.pixmap)
-                    
-                    # Draw label for each layer
-                    pen = QPen(layer.color, 2, Qt.PenStyle.DashLine)
-                    self.painter.setPen(pen)
-                    # boundingRect = layer.pixmap.rect()
-                    # textX = boundingRect.center().x()
-                    # textY = boundingRect.center().y() 
-                    # self.painter.drawText(QPoint(textX, textY + 10), layer.label)
-
+            if self.zoom != 1 or self.width() != self.baseSide():
+                self.paintZoomed()
+            (self.source or self).drawAnnotations(self.painter)
         finally:
             self.painter.end()
+        for mirror in self.mirrors:
+            mirror.update()
+
+    def drawAnnotations(self, painter):
+        #   In base coordinates, mirrors call this on their source with their own view transform
+        fontMetrics = QFontMetrics(painter.font())
+        for shape in self.store:
+            pen = QPen(QColor(shape.color), 2, Qt.PenStyle.DashLine)
+            painter.setPen(pen)
+            x1, y1, x2, y2 = shape.bbox
+            if shape.kind == 'rectangle':
+                painter.drawRect(x1, y1, x2 - x1, y2 - y1)
+            else:
+                if shape.id == self.polygonId:
+                    for x, y in shape.points.tolist():
+                        painter.drawEllipse(x, y, 3, 3)
+                if len(shape.points) < 3:
+                    continue
+                if shape.cache is None:
+                    shape.cache = QPolygon([QPoint(x, y) for x, y in shape.points.tolist()])
+                painter.drawPolygon(shape.cache)
+
+            #   Draw text labels
+            textRect = fontMetrics.boundingRect(shape.label)
+            textX = (x1 + x2) // 2 - textRect.width() // 2
+            textY = (y1 + y2) // 2 - textRect.height() // 2
+            painter.drawText(QPoint(textX, textY + 10), shape.label)
+
+        if self.currentRectangle:
+            #   Current active rectangle
+            start, end = self.currentRectangle
+            pen = QPen(self.currentLabelColor, 2, Qt.PenStyle.DashLine)
+            painter.setPen(pen)
+            rect = QRect(start, end)
+            painter.drawRect(rect)
+
+            #   Draw text labels
+            textRect = fontMetrics.boundingRect(self.currentLabelName)
+            textX = rect.center().x() - textRect.width() // 2
+            textY = rect.center().y() - textRect.height() // 2 
+            painter.drawText(QPoint(textX, textY + 10 ),self.currentLabelName)
+
+        #   Draw all paint layers, only their allocated tiles
+        painter.setOpacity(0.4)
+        for layer in self.paintLayers:
+            layer.draw(painter)
+        painter.setOpacity(1.0)
+
+    def paintZoomed(self):
+        #   Base coordinates from here on, so the annotations draw unchanged. The label pixmap
+        #   scaled to the base square is the backdrop, rendered tiles of the visible region go on top
+        scale, side = self.viewScale(), self.baseSide()
+        transform = QTransform().scale(scale, scale).translate(-self.offset.x(), -self.offset.y())
+        self.painter.setTransform(transform)
+        self.painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        pixmap = self.pixmap()
+        if pixmap is not None and not pixmap.isNull():
+            self.painter.drawPixmap(QRectF(0, 0, side, side), pixmap, QRectF(pixmap.rect()))
+        if self.tiles is not None:
+            (rows, cols), tiles = self.tiles
+            scaleX, scaleY = side / cols, side / rows
+            for x, y, pixels in tiles:
+                height, width = pixels.shape
+                image = QImage(pixels.data, width, height, pixels.strides[0], QImage.Format.Format_Grayscale8)
+                self.painter.drawImage(QRectF(x * scaleX, y * scaleY, width * scaleX, height * scaleY), image)
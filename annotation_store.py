@@ -0,0 +1,117 @@
+#   Rectangles and polygons of one image, keyed by id (no PyQt6, batch_export.py uses it too)
+
+import numpy as np
+from spatial_index import GridIndex
+
+class Shape:
+
+    #   points: int32 (n, 2) array in base (display) coordinates, the two corners as drawn for a
+    #   rectangle. cache is free for the GUI (its QPolygon), it is reset whenever the points change
+    __slots__ = ('id', 'kind', 'label', 'color', 'points', 'cache')
+
+    def __init__(self, id, kind, label, color, points):
+        self.id = id
+        self.kind = kind
+        self.label = label
+        self.color = color
+        self.points = points
+        self.cache = None
+
+    @property
+    def bbox(self):
+        #   Normalized (x1, y1, x2, y2)
+        x1, y1 = self.points.min(axis=0)
+        x2, y2 = self.points.max(axis=0)
+        return int(x1), int(y1), int(x2), int(y2)
+
+class AnnotationStore:
+
+    #   Shapes in drawing order by id, the same records grouped by label, and a grid index per kind
+    #   for hit-testing. Ids are never reused, a higher id is on top
+
+    kinds = ('rectangle', 'polygon')
+
+    def __init__(self, cellSize=32):
+        self.shapes = {}
+        self.byLabel = {}
+        self.indexes = {kind: GridIndex(cellSize) for kind in self.kinds}
+        self.nextId = 0
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __iter__(self):
+        return iter(list(self.shapes.values()))
+
+    def __contains__(self, id):
+        return id in self.shapes
+
+    def get(self, id):
+        return self.shapes.get(id)
+
+    def add(self, kind, label, color, points):
+        self.nextId += 1
+        shape = Shape(self.nextId, kind, label, color, np.array(points, dtype=np.int32).reshape(-1, 2))
+        self.shapes[shape.id] = shape
+        self.byLabel.setdefault(label, {})[shape.id] = shape
+        self.indexes[kind].insert(shape.id, shape.bbox)
+        return shape
+
+    def ofKind(self, kind):
+        return [shape for shape in self.shapes.values() if shape.kind == kind]
+
+    def labels(self, kind=None):
+        return [label for label, shapes in self.byLabel.items()
+                if any(kind is None or shape.kind == kind for shape in shapes.values())]
+
+    def withLabel(self, label, kind=None):
+        return [shape for shape in self.byLabel.get(label, {}).values() if kind is None or shape.kind == kind]
+
+    def setPoints(self, id, points):
+        shape = self.shapes[id]
+        shape.points = np.array(points, dtype=np.int32).reshape(-1, 2)
+        shape.cache = None
+        self.indexes[shape.kind].update(id, shape.bbox)
+
+    def appendPoint(self, id, x, y):
+        shape = self.shapes[id]
+        self.setPoints(id, np.vstack((shape.points, (x, y))))
+
+    def move(self, id, dx, dy):
+        shape = self.shapes[id]
+        shape.points += (dx, dy)
+        shape.cache = None
+        self.indexes[shape.kind].update(id, shape.bbox)
+
+    def remove(self, id):
+        shape = self.shapes.pop(id, None)
+        if shape is None:
+            return
+        self.indexes[shape.kind].remove(id)
+        shapes = self.byLabel[shape.label]
+        del shapes[id]
+        if not shapes:
+            del self.byLabel[shape.label]
+
+    def removeLabel(self, label, kind=None):
+        for shape in self.withLabel(label, kind):
+            self.remove(shape.id)
+
+    def rename(self, label, newLabel):
+        shapes = self.byLabel.pop(label, {})
+        for shape in shapes.values():
+            shape.label = newLabel
+        self.byLabel.setdefault(newLabel, {}).update(shapes)
+
+    def recolor(self, label, color):
+        for shape in self.byLabel.get(label, {}).values():
+            shape.color = color
+
+    def hit(self, kind, x, y):
+        #   Topmost shape of kind whose bounding box contains the point, or None
+        id = self.indexes[kind].hit(x, y)
+        return None if id is None else self.shapes[id]
+
+    def clear(self, kind=None):
+        for shape in self.ofKind(kind) if kind is not None else list(self.shapes.values()):
+            self.remove(shape.id)
@@ -0,0 +1,156 @@
+#   Headless batch export: rasterizes stored annotations to masks on a process pool (no PyQt6)
+#
+#   python batch_export.py manifest.json [--workers N] [--checkpoint FILE]
+#
+#   The manifest is a JSON list of jobs, paths are relative to the manifest:
+#   {
+#       "image": "study/0001.dcm",                 DICOM or NIfTI, only its shape and dtype are used
+#       "output": "masks/0001",                    prefix, the exporters append '_<label>_mask...'
+#       "format": "npy",                           npy, nii, csv or json
+#       "displaySize": 540,                        side of the square display the annotations were drawn on
+#       "rectangles": [{"label": "lesion", "bbox": [x1, y1, x2, y2]}],
+#       "polygons": [{"label": "liver", "points": [[x, y], ...]}],
+#       "paint": [{"label": "edema", "mask": "masks/0001_edema.npy"}]
+#   }
+#   Coordinates and paint masks are in display pixels, exactly as the GUI stores them
+#   Rectangles and polygons with the same label share one mask, csv/json list both kinds in one table
+
+#   Imports
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+from image_loader import DicomLoader, headerInfo
+from save_manager import DicomSaver
+from annotation_store import AnnotationStore
+
+#   Worker side
+
+def loadImage(path):
+    #   Only the header is read: the exporters need the image's shape and dtype, never its pixels.
+    #   The dtype follows the GUI's compact policy, np.zeros leaves the pages untouched
+    if path.lower().endswith('.nii') or path.lower().endswith('.nii.gz'):
+        import nibabel as nib
+        proxy = nib.load(path).dataobj
+        dtype = proxy.dtype if (proxy.slope, proxy.inter) == (1, 0) else np.dtype(np.float32)
+        if dtype == np.float64:
+            dtype = np.dtype(np.float32)
+        #   NIfTI is (x, y), the loader transposes to rows first
+        return np.zeros((proxy.shape[1], proxy.shape[0]), dtype=dtype)
+
+    import pydicom
+    dicom = pydicom.dcmread(path, stop_before_pixels=True)
+    header = headerInfo(dicom, path)
+    return np.zeros((header['rows'], header['cols']), dtype=DicomLoader().compactDtype(dicom))
+
+def exportJob(job):
+    #   Returns (output, error), errors are reported instead of raised so one bad study does not stop the run
+    try:
+        path, fmt = job['output'], job.get('format', 'npy')
+        if job.get('paint') and fmt not in ('npy', 'nii'):
+            return path, f'{fmt} export for paint is not available'
+
+        arr = loadImage(job['image'])
+        saver = DicomSaver()
+        saver.actImgW = arr.shape[0]
+        saver.dspImgW = job['displaySize']
+        saver.updateTr()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        store = AnnotationStore()
+        for rectangle in job.get('rectangles', []):
+            x1, y1, x2, y2 = rectangle['bbox']
+            store.add('rectangle', rectangle['label'], None, ((x1, y1), (x2, y2)))
+        for polygon in job.get('polygons', []):
+            store.add('polygon', polygon['label'], None, polygon['points'])
+
+        #   Both kinds go through one exporter, so a polygon cannot overwrite a rectangle's file
+        if len(store):
+            if fmt == 'npy':
+                saver.shapes2npy(path, arr, store)
+            elif fmt == 'nii':
+                saver.shapes2nii(path, arr, store)
+            elif fmt == 'csv':
+                saver.shapes2csv(path, arr, store, job['image'])
+            elif fmt == 'json':
+                saver.shapes2json(path, arr, store, job['image'])
+
+        layers = [SimpleNamespace(label=layer['label'], mask=np.load(layer['mask'])) for layer in job.get('paint', [])]
+        if fmt == 'npy':
+            saver.paint2npy(path, arr, layers)
+        elif fmt == 'nii':
+            saver.paint2nii(path, arr, layers)
+        return path, None
+    except Exception as error:
+        return job['output'], f'{type(error).__name__}: {error}'
+
+#   Driver side
+
+def readManifest(manifestPath):
+    folder = os.path.dirname(os.path.abspath(manifestPath))
+    with open(manifestPath) as manifest:
+        jobs = json.load(manifest)
+
+    def resolve(path):
+        return path if os.path.isabs(path) else os.path.join(folder, path)
+
+    for job in jobs:
+        job['image'] = resolve(job['image'])
+        job['output'] = resolve(job['output'])
+        for layer in job.get('paint', []):
+            layer['mask'] = resolve(layer['mask'])
+    return jobs
+
+def readCheckpoint(checkpointPath):
+    #   One finished output prefix per line, a line cut short by an interruption is ignored
+    if not os.path.exists(checkpointPath):
+        return set()
+    with open(checkpointPath) as checkpoint:
+        return {line.rstrip('\n') for line in checkpoint if line.endswith('\n')}
+
+def run(manifestPath, workers=None, checkpointPath=None, chunkSize=8, reportEvery=5.0):
+    checkpointPath = checkpointPath or manifestPath + '.done'
+    jobs = readManifest(manifestPath)
+    done = readCheckpoint(checkpointPath)
+    pending = [job for job in jobs if job['output'] not in done]
+    print(f'{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to export')
+
+    exported, failed = 0, 0
+    start = lastReport = time.perf_counter()
+    with open(checkpointPath, 'a') as checkpoint, ProcessPoolExecutor(max_workers=workers) as pool:
+        for output, error in pool.map(exportJob, pending, chunksize=chunkSize):
+            if error is None:
+                exported += 1
+                checkpoint.write(output + '\n')
+                checkpoint.flush()
+            else:
+                failed += 1
+                print(f'failed: {output}: {error}', file=sys.stderr)
+
+            now = time.perf_counter()
+            if now - lastReport >= reportEvery:
+                lastReport = now
+                finished = exported + failed
+                print(f'{finished}/{len(pending)}  {finished / (now - start):.1f} jobs/s')
+
+    elapsed = time.perf_counter() - start
+    rate = (exported + failed) / elapsed if elapsed > 0 else 0.0
+    print(f'exported {exported}, failed {failed} in {elapsed:.1f} s ({rate:.1f} jobs/s)')
+    return exported, failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Export annotation masks for a manifest of studies without the GUI.')
+    parser.add_argument('manifest', help='JSON list of export jobs')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--checkpoint', default=None, help='resume file (default: <manifest>.done)')
+    parser.add_argument('--chunk-size', type=int, default=8, help='jobs handed to a worker at a time')
+    args = parser.parse_args()
+    _, failed = run(args.manifest, args.workers, args.checkpoint, args.chunk_size)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#   Memory comparison of the dtype policies: 'compact' (int16 with integer rescale) against 'legacy'
+#
+#   python bench_dtype_memory.py [--sizes 512 3000] [--renders 5]
+#
+#   One synthetic CT slice per size (int16 stored, slope 1, intercept -1024) is loaded with each
+#   policy. Reports the bytes kept as loader.data, the tracemalloc peak of the decode and the time
+#   of a render at a new window. Exits 1 when compact data is not at most half of legacy
+
+#   Imports
+import os
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from image_loader import DicomLoader
+
+def writeSlice(path, size):
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    dicom = Dataset()
+    dicom.file_meta = meta
+    dicom.SOPClassUID = CTImageStorage
+    dicom.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    dicom.Modality = 'CT'
+    dicom.WindowCenter, dicom.WindowWidth = 40, 400
+    dicom.RescaleSlope, dicom.RescaleIntercept = 1, -1024
+    dicom.Rows = dicom.Columns = size
+    dicom.SamplesPerPixel = 1
+    dicom.PhotometricInterpretation = 'MONOCHROME2'
+    dicom.BitsAllocated, dicom.BitsStored, dicom.HighBit = 16, 12, 11
+    dicom.PixelRepresentation = 0
+    dicom.PixelData = np.random.default_rng(0).integers(0, 3000, (size, size), dtype=np.uint16).tobytes()
+    pydicom.dcmwrite(path, dicom, enforce_file_format=True)
+
+def measure(path, policy, renders):
+    loader = DicomLoader(dtypePolicy=policy)
+    loader.denoise = 'none'
+    tracemalloc.start()
+    loader.di2num(path)
+    decodePeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    #   Legacy data is already VOI-windowed, so the render windows are taken from each data range
+    low, high = loader.dataMin, loader.dataMax
+    loader.firstLoadFlag = False
+    loader.wc, loader.ww = round((low + high) / 2), max(1, round((high - low) / 2))
+    loader.display(loader.data)
+    times = []
+    for step in range(1, renders + 1):
+        loader.wc += max(1, loader.ww // 50)
+        start = time.perf_counter()
+        loader.display(loader.data)
+        times.append((time.perf_counter() - start) * 1000)
+    return loader.data.dtype, loader.data.nbytes, decodePeak, float(np.median(times))
+
+def run(sizes=(512, 3000), renders=5):
+    ok = True
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            path = os.path.join(folder, f'{size}.dcm')
+            writeSlice(path, size)
+            results = {policy: measure(path, policy, renders) for policy in ('legacy', 'compact')}
+            for policy, (dtype, nbytes, peak, ms) in results.items():
+                print(f'{size}x{size} {policy:8} data {dtype.name:8} {nbytes / (1 << 20):7.1f} MB, '
+                      f'decode peak {peak / (1 << 20):7.1f} MB, render {ms:.1f} ms')
+            if results['compact'][1] * 2 > results['legacy'][1]:
+                print(f'FAIL: {size}x{size} compact data is not at most half of legacy', file=sys.stderr)
+                ok = False
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory of the compact and legacy dtype policies.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 3000], help='sides of the synthetic slices')
+    parser.add_argument('--renders', type=int, default=5, help='renders timed per policy, each at a new window')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.sizes, args.renders) else 1)
+
+if __name__ == '__main__':
+    main()
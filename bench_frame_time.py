@@ -0,0 +1,73 @@
+#   Frame-time benchmark: the old matplotlib round-trip of MainWindow.displayImage against toQImage
+#
+#   python bench_frame_time.py [--sizes 512 2048] [--frames 30] [--height 540]
+#
+#   Both paths take the uint8 array DicomLoader.display returns and end with a pixmap of the label
+#   height, so the windowing stages (the same for both) are left out. Runs under
+#   QT_QPA_PLATFORM=offscreen unless another platform is set
+
+#   Imports
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt6.QtCore import Qt
+from PyQt6.QtGui import QImage, QPixmap
+from PyQt6.QtWidgets import QApplication
+from render_scheduler import toQImage
+
+def matplotlibFrame(array, height):
+    #   What displayImage did before: a 5x5 inch figure rasterized by Agg, copied out and smooth-scaled
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(5, 5))
+    ax.imshow(array, cmap='gray', aspect='auto')
+    ax.axis('off')
+    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+    fig.canvas.draw()
+    width, figHeight = fig.canvas.get_width_height()
+    #   tostring_rgb is gone from newer matplotlib, buffer_rgba is the same copy with alpha
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    qImage = QImage(image.data, width, figHeight, QImage.Format.Format_RGBA8888)
+    pixmap = QPixmap.fromImage(qImage).scaledToHeight(height, Qt.TransformationMode.SmoothTransformation)
+    plt.close(fig)
+    return pixmap
+
+def directFrame(array, height):
+    return QPixmap.fromImage(toQImage(array, height))
+
+def frameTimes(render, array, height, frames):
+    render(array, height)
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        render(array, height)
+        times.append((time.perf_counter() - start) * 1000)
+    return float(np.median(times)), float(np.percentile(times, 95))
+
+def run(sizes=(512, 2048), frames=30, height=540):
+    #   QPixmap needs a QGuiApplication, kept alive until the timings are done
+    app = QApplication.instance() or QApplication(sys.argv)
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        array = rng.integers(0, 256, (size, size), dtype=np.uint8)
+        before = frameTimes(matplotlibFrame, array, height, frames)
+        after = frameTimes(directFrame, array, height, frames)
+        print(f'{size}x{size} -> {height} px   matplotlib {before[0]:7.2f} ms (p95 {before[1]:.2f})   '
+              f'toQImage {after[0]:6.2f} ms (p95 {after[1]:.2f})   {before[0] / after[0]:.0f}x')
+
+def main():
+    parser = argparse.ArgumentParser(description='Time one display frame, matplotlib round-trip vs toQImage.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 2048], help='sides of the synthetic images')
+    parser.add_argument('--frames', type=int, default=30, help='frames timed per path and size')
+    parser.add_argument('--height', type=int, default=540, help='height of the image label')
+    args = parser.parse_args()
+    run(args.sizes, args.frames, args.height)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#   Bounded-memory check for NIfTI browsing: steps through every slice of a large synthetic volume
+#
+#   python bench_nifti_rss.py [--shape 512 512 1000] [--max-mb 200] [--compressed]
+#
+#   The volume is written slice by slice to a temporary .nii (or .nii.gz), so it is never in memory
+#   as a whole. Anonymous RSS (heap and arrays) has to stay within max-mb of what it was before the
+#   load, exits 1 otherwise. File-backed RSS of the memory-mapped .nii is reported too, those pages
+#   belong to the page cache and the kernel takes them back under pressure. Linux only (/proc)
+
+#   Imports
+import os
+import sys
+import time
+import gzip
+import argparse
+import tempfile
+import numpy as np
+from image_loader import NiftiLoader
+
+def rss():
+    #   (anonymous, file-backed) resident MB of this process
+    values = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(('RssAnon:', 'RssFile:')):
+                name, kb, _ = line.split()
+                values[name] = int(kb) / 1024
+    return values['RssAnon:'], values['RssFile:']
+
+def syntheticSlice(shape, index):
+    #   Smooth body-like disc plus noise, int16 CT range, (x, y) like NIfTI stores it
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    radius = np.hypot(x - shape[0] / 2, y - shape[1] / 2)
+    plane = np.where(radius < min(shape[:2]) * (0.3 + 0.1 * np.sin(index / 50)), 40.0, -1000.0)
+    plane += np.random.default_rng(index).normal(0, 20, shape[:2])
+    return plane.astype(np.int16)
+
+def writeVolume(path, shape):
+    import nibabel as nib
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(np.int16)
+    header.set_qform(np.eye(4), code=1)
+    header['vox_offset'] = 352
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as file:
+        header.write_to(file)
+        file.write(b'\0' * (352 - 348))
+        for index in range(shape[2]):
+            #   Voxels are in Fortran order, x varies fastest
+            file.write(np.asfortranarray(syntheticSlice(shape, index)).tobytes(order='F'))
+
+def browse(path, denoise):
+    loader = NiftiLoader()
+    loader.denoise = denoise
+    anonBefore, _ = rss()
+    start = time.perf_counter()
+    loader.ni2num(path)
+    peakAnon, peakFile = rss()
+    for index in range(loader.sliceCount):
+        loader.setSlice(index)
+        loader.display(loader.data)
+        anon, file = rss()
+        peakAnon, peakFile = max(peakAnon, anon), max(peakFile, file)
+    return loader.sliceCount, time.perf_counter() - start, peakAnon - anonBefore, peakFile
+
+def run(shape=(512, 512, 1000), maxMb=200.0, compressed=False, denoise='none'):
+    volumeMb = np.prod(shape) * 2 / (1 << 20)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'volume.nii.gz' if compressed else 'volume.nii')
+        writeVolume(path, shape)
+        slices, seconds, anonGrowth, peakFile = browse(path, denoise)
+
+    print(f'{os.path.basename(path)} {"x".join(map(str, shape))} int16, {volumeMb:.0f} MB of voxels')
+    print(f'browsed {slices} slices in {seconds:.1f} s ({slices / seconds:.0f} slices/s)')
+    print(f'anonymous RSS growth {anonGrowth:.0f} MB (max {maxMb:.0f}), peak file-backed RSS {peakFile:.0f} MB')
+    if anonGrowth > maxMb:
+        print(f'FAIL: browsing grew anonymous RSS by more than {maxMb:g} MB', file=sys.stderr)
+        return False
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that browsing a large NIfTI volume keeps RSS bounded.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 1000], help='x y z of the synthetic volume')
+    parser.add_argument('--max-mb', type=float, default=200.0, help='allowed anonymous RSS growth')
+    parser.add_argument('--compressed', action='store_true', help='write .nii.gz (decoded slices cached) instead of a memory-mapped .nii')
+    parser.add_argument('--denoise', default='none', help="denoise stage: 'none', 'bilateral', 'guided' or 'auto'")
+    args = parser.parse_args()
+    sys.exit(0 if run(tuple(args.shape), args.max_mb, args.compressed, args.denoise) else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#   Peak memory per render with tracemalloc: the caching pipeline against the buffer-reusing one
+#
+#   python bench_render_memory.py [--size 3000] [--renders 5] [--max-mb 16] [--denoise MODE ...]
+#
+#   A synthetic size x size CR/DX-like plane (int16 and float32) is rendered at a new window each
+#   time, like a slider drag, with every denoise mode by default. With reuseBuffers the stages write
+#   into the loader's work buffers, exits 1 when a render in that mode still allocates more than
+#   max-mb at its peak
+
+#   Imports
+import sys
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from image_loader import DicomLoader
+
+def syntheticPlane(size, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(500, 300, (size, size)).astype(dtype)
+
+def renderPeaks(plane, reuseBuffers, renders, denoise):
+    #   The first render (stats, pyramid, buffers) is left out, the loop is the steady state
+    loader = DicomLoader(reuseBuffers=reuseBuffers)
+    loader.denoise = denoise
+    loader.data = plane
+    loader.updateStats()
+    loader.firstLoadFlag = False
+    loader.wc, loader.ww = 400, 1000
+    loader.display(loader.data)
+
+    peaks, times = [], []
+    for step in range(1, renders + 1):
+        loader.wc = 400 + step * 10
+        tracemalloc.start()
+        start = time.perf_counter()
+        loader.display(loader.data)
+        times.append((time.perf_counter() - start) * 1000)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return max(peaks), float(np.median(times))
+
+def run(size=3000, renders=5, maxMb=16.0, denoiseModes=('none', 'bilateral', 'guided')):
+    ok = True
+    for dtype in (np.int16, np.float32):
+        plane = syntheticPlane(size, dtype)
+        for denoise in denoiseModes:
+            for reuseBuffers in (False, True):
+                peak, ms = renderPeaks(plane, reuseBuffers, renders, denoise)
+                mode = 'reuseBuffers' if reuseBuffers else 'stage caches'
+                name = f'{np.dtype(dtype).name} {denoise}'
+                print(f'{name:18} {mode:13} peak {peak / (1 << 20):6.1f} MB per render, {ms:.0f} ms')
+                if reuseBuffers and peak > maxMb * (1 << 20):
+                    print(f'FAIL: {name} render with reuseBuffers peaks over {maxMb:g} MB', file=sys.stderr)
+                    ok = False
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description='Report tracemalloc peak memory per render.')
+    parser.add_argument('--size', type=int, default=3000, help='side of the synthetic plane')
+    parser.add_argument('--renders', type=int, default=5, help='renders per mode, each at a new window')
+    parser.add_argument('--max-mb', type=float, default=16.0, help='allowed peak per render with reuseBuffers')
+    parser.add_argument('--denoise', nargs='+', default=['none', 'bilateral', 'guided'],
+                        help="denoise modes to run: 'none', 'bilateral', 'guided' or 'auto'")
+    args = parser.parse_args()
+    sys.exit(0 if run(args.size, args.renders, args.max_mb, args.denoise) else 1)
+
+if __name__ == '__main__':
+    main()
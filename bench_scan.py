@@ -0,0 +1,88 @@
+#   Folder triage benchmark: files/s of the header-only scanDirectory against full pixel decoding
+#
+#   python bench_scan.py [--files 1000] [--size 512] [--workers N] [--folder DIR]
+#
+#   Writes a synthetic series of uncompressed int16 CT slices to a temporary folder (or reuses the
+#   .dcm files of --folder) and reads it three ways: dcmread plus pixel_array one file after the
+#   other like di2num, scanDirectory on one thread, and scanDirectory on the thread pool
+
+#   Imports
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from image_loader import scanDirectory
+
+def writeSeries(folder, count, size):
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, CTImageStorage, generate_uid
+
+    seriesUid = generate_uid()
+    pixels = np.random.default_rng(0).integers(-1024, 2000, (size, size), dtype=np.int16)
+    for index in range(count):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+        dicom = Dataset()
+        dicom.file_meta = meta
+        dicom.SOPClassUID = CTImageStorage
+        dicom.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        dicom.SeriesInstanceUID = seriesUid
+        dicom.Modality = 'CT'
+        dicom.InstanceNumber = index + 1
+        dicom.ImagePositionPatient = [0.0, 0.0, float(index)]
+        dicom.PixelSpacing = [0.7, 0.7]
+        dicom.WindowCenter, dicom.WindowWidth = 40, 400
+        dicom.RescaleSlope, dicom.RescaleIntercept = 1, 0
+        dicom.Rows = dicom.Columns = size
+        dicom.SamplesPerPixel = 1
+        dicom.PhotometricInterpretation = 'MONOCHROME2'
+        dicom.BitsAllocated, dicom.BitsStored, dicom.HighBit = 16, 16, 15
+        dicom.PixelRepresentation = 1
+        dicom.PixelData = pixels.tobytes()
+        pydicom.dcmwrite(os.path.join(folder, f'{index:05d}.dcm'), dicom, enforce_file_format=True)
+
+def fullDecode(folder):
+    #   What a folder of di2num calls costs: every file read and its pixels decoded
+    import pydicom
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith('.dcm'))
+    for path in paths:
+        pydicom.dcmread(path).pixel_array
+    return paths
+
+def filesPerSecond(read, folder):
+    start = time.perf_counter()
+    count = len(read(folder))
+    return count, count / (time.perf_counter() - start)
+
+def run(folder, workers=None):
+    modes = (('dcmread + pixel_array', fullDecode),
+             ('headers, 1 thread', lambda folder: scanDirectory(folder, maxWorkers=1)),
+             (f'headers, {workers or "default"} threads', lambda folder: scanDirectory(folder, maxWorkers=workers)))
+    results = {}
+    for name, read in modes:
+        count, rate = filesPerSecond(read, folder)
+        results[name] = rate
+        print(f'{name:24} {count} files  {rate:8.0f} files/s')
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure files/s of header-only DICOM scanning.')
+    parser.add_argument('--files', type=int, default=1000, help='synthetic files to write')
+    parser.add_argument('--size', type=int, default=512, help='rows and columns of each slice')
+    parser.add_argument('--workers', type=int, default=None, help='scan threads (default: the pool default)')
+    parser.add_argument('--folder', default=None, help='existing folder of .dcm files instead of a synthetic one')
+    args = parser.parse_args()
+    if args.folder:
+        run(args.folder, args.workers)
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        writeSeries(folder, args.files, args.size)
+        run(folder, args.workers)
+
+if __name__ == '__main__':
+    main()
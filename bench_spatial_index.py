@@ -0,0 +1,75 @@
+#   Hit-testing benchmark: GridIndex against the linear scan over every box it replaced (no PyQt6)
+#
+#   python bench_spatial_index.py [--boxes 10000] [--size 540]
+#
+#   Random boxes of 4 to 20 px on a size x size display, random query points. The linear scan is
+#   timed on a sample of the points and must return the same topmost box as the index
+
+#   Imports
+import time
+import random
+import argparse
+from spatial_index import GridIndex
+
+def randomBoxes(count, size, rng):
+    boxes = []
+    for _ in range(count):
+        x, y = rng.uniform(0, size - 20), rng.uniform(0, size - 20)
+        boxes.append((x, y, x + rng.uniform(4, 20), y + rng.uniform(4, 20)))
+    return boxes
+
+def linearHit(boxes, x, y):
+    #   Ids are 1-based positions, the last box containing the point is on top
+    top = None
+    for id, (x1, y1, x2, y2) in enumerate(boxes, 1):
+        if x1 <= x <= x2 and y1 <= y <= y2:
+            top = id
+    return top
+
+def perCall(start, count):
+    return (time.perf_counter() - start) / count * 1e6
+
+def run(count=10000, size=540, cellSize=32, linearSample=500, seed=0):
+    rng = random.Random(seed)
+    boxes = randomBoxes(count, size, rng)
+    points = [(rng.uniform(0, size), rng.uniform(0, size)) for _ in range(count)]
+
+    index = GridIndex(cellSize)
+    start = time.perf_counter()
+    for id, box in enumerate(boxes, 1):
+        index.insert(id, box)
+    insertUs = perCall(start, count)
+
+    start = time.perf_counter()
+    hits = [index.hit(x, y) for x, y in points]
+    hitUs = perCall(start, count)
+
+    sample = points[:linearSample]
+    start = time.perf_counter()
+    expected = [linearHit(boxes, x, y) for x, y in sample]
+    linearUs = perCall(start, len(sample))
+    if expected != hits[:len(sample)]:
+        raise AssertionError('GridIndex.hit disagrees with the linear scan')
+
+    #   A one pixel drag of every box, what mouseMoveEvent does to the selected shape
+    start = time.perf_counter()
+    for id in range(1, count + 1):
+        x1, y1, x2, y2 = index.boxes[id]
+        index.update(id, (x1 + 1, y1 + 1, x2 + 1, y2 + 1))
+    updateUs = perCall(start, count)
+
+    print(f'{count} boxes on {size}x{size}, cell {cellSize} px')
+    print(f'insert {insertUs:.2f} us, update {updateUs:.2f} us')
+    print(f'hit {hitUs:.2f} us, linear scan {linearUs:.1f} us ({linearUs / hitUs:.0f}x)')
+    return {'insert': insertUs, 'update': updateUs, 'hit': hitUs, 'linear': linearUs}
+
+def main():
+    parser = argparse.ArgumentParser(description='Time GridIndex hit-testing against a linear scan.')
+    parser.add_argument('--boxes', type=int, default=10000, help='number of boxes')
+    parser.add_argument('--size', type=int, default=540, help='side of the display in pixels')
+    parser.add_argument('--cell-size', type=int, default=32, help='GridIndex cell size')
+    args = parser.parse_args()
+    run(args.boxes, args.size, args.cell_size)
+
+if __name__ == '__main__':
+    main()
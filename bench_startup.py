@@ -0,0 +1,100 @@
+#   Cold start benchmark: import time of gui and time to the first shown window, exits 1 on a regression
+#
+#   python bench_startup.py [--runs 5] [--max-import-ms 1000] [--max-window-ms 2000]
+#
+#   Each run is a fresh interpreter. Import times come from python -X importtime, the window is
+#   shown under QT_QPA_PLATFORM=offscreen and timed from process start to the first processEvents().
+#   Medians are compared to the thresholds, and none of the heavy modules may be imported at startup
+
+#   Imports
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+#   Needed only for export or specific file types, they are imported on first use
+heavyModules = ('matplotlib', 'pandas', 'skimage', 'nibabel', 'scipy', 'cv2', 'pydicom')
+
+firstWindow = '''
+import sys
+from PyQt6.QtWidgets import QApplication
+from main import MainWindow
+app = QApplication(sys.argv)
+window = MainWindow()
+window.show()
+app.processEvents()
+print('shown', flush=True)
+'''
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def parseImportTime(stderr, target='gui'):
+    #   'import time: self [us] | cumulative | imported package', nested imports are indented two
+    #   spaces per level and listed before their importer. Returns the target's cumulative time,
+    #   its direct imports {name: cumulative us} and the names of every module loaded
+    total, children, pending, names = 0, {}, {}, set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        names.add(name)
+        if depth == 1:
+            pending[name] = int(cumulative)
+        elif depth == 0:
+            if name == target:
+                total, children = int(cumulative), pending
+            pending = {}
+    return total, children, names
+
+def importRun():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import gui'],
+                            cwd=here, capture_output=True, text=True, check=True)
+    return parseImportTime(result.stderr)
+
+def windowRun():
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    start = time.perf_counter()
+    child = subprocess.Popen([sys.executable, '-c', firstWindow], cwd=here, env=env,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = child.stdout.readline()
+    elapsed = (time.perf_counter() - start) * 1000
+    child.wait()
+    if line.strip() != 'shown':
+        raise RuntimeError(f'the window did not come up (exit code {child.returncode})')
+    return elapsed
+
+def run(runs=5, maxImportMs=1000.0, maxWindowMs=2000.0):
+    imports = [importRun() for _ in range(runs)]
+    importMs = statistics.median(total for total, _, _ in imports) / 1000
+    loaded = sorted({name.split('.')[0] for _, _, names in imports for name in names} & set(heavyModules))
+    windowMs = statistics.median(windowRun() for _ in range(runs))
+
+    slowest = sorted(imports[-1][1].items(), key=lambda item: item[1], reverse=True)[:5]
+    print(f'import gui {importMs:.0f} ms (max {maxImportMs:.0f}), first window {windowMs:.0f} ms (max {maxWindowMs:.0f}), median of {runs}')
+    print('slowest imports of gui: ' + ', '.join(f'{name} {value / 1000:.0f} ms' for name, value in slowest))
+
+    failures = []
+    if importMs > maxImportMs:
+        failures.append('import gui is over the threshold')
+    if windowMs > maxWindowMs:
+        failures.append('first window is over the threshold')
+    if loaded:
+        failures.append('imported at startup: ' + ', '.join(loaded))
+    for failure in failures:
+        print(f'FAIL: {failure}', file=sys.stderr)
+    return not failures
+
+def main():
+    parser = argparse.ArgumentParser(description='Check cold start time against regression thresholds.')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per measurement')
+    parser.add_argument('--max-import-ms', type=float, default=1000.0, help='threshold for import gui')
+    parser.add_argument('--max-window-ms', type=float, default=2000.0, help='threshold for the first window')
+    args = parser.parse_args()
+    sys.exit(0 if run(args.runs, args.max_import_ms, args.max_window_ms) else 1)
+
+if __name__ == '__main__':
+    main()
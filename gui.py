@@ -2,16 +2,113 @@
 
 #   Imports
 import os
+import math
 import numpy as np
-from matplotlib import pyplot as plt
 from annotation import AnnotatableImageDisplay, LabelCard 
 from utils import WindowingSlider
-from image_loader import DicomLoader 
+from image_loader import DicomLoader, NiftiLoader, Prefetcher, scanDirectory, groupSeries
 from save_manager import DicomSaver
-from PyQt6.QtCore import QSize, Qt, QRect, QPoint, pyqtSignal, pyqtSlot
-from PyQt6.QtGui import QAction, QIcon, QMouseEvent, QPixmap, QImage, QPainter, QPen, QColor
+from render_scheduler import RenderScheduler, PresetCache, toQImage
+from instrumentation import registry
+from PyQt6.QtCore import QSize, Qt, QRect, QPoint, QTimer, pyqtSignal, pyqtSlot
+from PyQt6.QtGui import QAction, QActionGroup, QIcon, QMouseEvent, QPixmap, QImage, QPainter, QPen, QColor
 from PyQt6.QtWidgets import (QSlider, QDialog, QFileDialog, QHBoxLayout, QLabel, QLineEdit, QMainWindow, QToolButton,
-    QVBoxLayout, QWidget, QSizePolicy, QStatusBar, QDialogButtonBox, QPushButton, QColorDialog, QComboBox, QMessageBox)
+    QVBoxLayout, QWidget, QSizePolicy, QStatusBar, QDialogButtonBox, QPushButton, QColorDialog, QComboBox, QMessageBox,
+    QGridLayout)
+
+#   Windowing Presets
+WINDOW_PRESETS = [
+    {'name': 'Head & Neck: Brain', 'wc': 40, 'ww': 80},
+    {'name': 'Head & Neck: Subdural', 'wc': 75, 'ww': 215},
+    {'name': 'Head & Neck: Temporal Bones', 'wc': 600, 'ww': 2800},
+    {'name': 'Head & Neck: Soft Tissues', 'wc': 50, 'ww': 350},
+    {'name': 'Head & Neck: Stroke', 'wc': 40, 'ww': 40},
+    {'name': 'Chest: Lung', 'wc': -600, 'ww': 1500},
+    {'name': 'Chest: Mediastinum', 'wc': 50, 'ww': 350},
+    {'name': 'Abdomen: Soft Tissues', 'wc': 50, 'ww': 400},
+    {'name': 'Abdomen: Liver', 'wc': 70, 'ww': 150},
+    {'name': 'Spine: Soft Tissues', 'wc': 50, 'ww': 250},
+    {'name': 'Spine: Bone', 'wc': 400, 'ww': 1800},
+]
+
+#   Extra Viewport
+
+class ViewportPanel(QWidget):
+
+    #   One more view of the main display's image: its own window and render cache, while the
+    #   loader (raw pixels), annotations, pan/zoom and slice are the main display's
+
+    def __init__(self, source, presetIndex, parent=None):
+        super().__init__(parent)
+        self.loader = None
+        self.tileKey = None
+        self.renderScheduler = RenderScheduler(self, setsWindow=False)
+        self.renderScheduler.rendered.connect(self.showRendered)
+        self.renderScheduler.tilesRendered.connect(self.showTiles)
+
+        self.presetComboBox = QComboBox(self)
+        self.presetComboBox.setStyleSheet('''
+            background-color: #3b3e45;
+            color: #ffffff;
+            border-radius: 5px;
+        ''')
+        for preset in WINDOW_PRESETS:
+            self.presetComboBox.addItem(preset['name'], preset)
+        self.presetComboBox.setCurrentIndex(presetIndex)
+        self.presetComboBox.currentIndexChanged.connect(self.render)
+
+        self.imageDisplay = AnnotatableImageDisplay('')
+        self.imageDisplay.setStyleSheet('''
+        background-color: #2c2f33;
+        border-radius: 25px;
+        ''')
+        self.imageDisplay.linkTo(source)
+        self.imageDisplay.viewChanged.connect(self.requestTiles)
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(2)
+        layout.addWidget(self.presetComboBox)
+        layout.addWidget(self.imageDisplay)
+
+    def window(self):
+        preset = self.presetComboBox.currentData()
+        return preset['wc'], preset['ww']
+
+    def setLoader(self, loader):
+        self.loader = loader
+        self.renderScheduler.clearCache()
+        self.render()
+
+    def render(self):
+        if self.loader is not None:
+            wc, ww = self.window()
+            self.renderScheduler.request(self.loader, wc, ww, self.imageDisplay.height(),
+                                         viewport=self.imageDisplay.viewRegion())
+
+    def requestTiles(self):
+        if self.loader is not None and self.imageDisplay.viewRegion() is not None:
+            self.render()
+
+    def currentTileKey(self):
+        return (self.loader, self.loader.sliceIndex, *self.window(), self.loader.denoise)
+
+    def showRendered(self, qImage, request):
+        loader, wc, ww, height, preview, viewport, plane = request
+        if loader is self.loader and (wc, ww) == self.window() and plane == (loader.dataKey, loader.sliceIndex):
+            if self.tileKey != self.currentTileKey():
+                self.imageDisplay.setTiles(None)
+            self.imageDisplay.setPixmap(QPixmap.fromImage(qImage))
+
+    def showTiles(self, tiles, request):
+        loader, wc, ww, height, preview, viewport, plane = request
+        if loader is self.loader and (wc, ww) == self.window() and plane == (loader.dataKey, loader.sliceIndex):
+            self.tileKey = self.currentTileKey()
+            self.imageDisplay.setTiles(tiles)
+
+    def stop(self):
+        self.renderScheduler.stop()
+        self.imageDisplay.unlink()
 
 #   Main Window
 
@@ -29,6 +126,40 @@ class MainWindow(QMainWindow):
         self.dicomSaver = DicomSaver()
         self.fltMin = 0
         self.fltMax = 0
+
+        #   Worklist of the folder the current file came from, neighbours are decoded ahead of time
+        self.worklist = []
+        self.worklistIndex = 0
+        self.filePrefetcher = Prefetcher(self.prefetchFile)
+        self.prefetchSettings = None
+        self.slicePrefetcher = None
+
+        #   Progressive rendering: slider input renders a cheap preview, the full
+        #   pipeline runs once the input has been idle for settleDelay ms
+        self.previewRender = False
+        self.settleTimer = QTimer(self)
+        self.settleTimer.setSingleShot(True)
+        self.settleTimer.setInterval(150)
+        self.settleTimer.timeout.connect(self.renderWindowed)
+
+        #   WC/WW renders run on a worker thread, only the latest request survives
+        self.windowWc = None
+        self.windowWw = None
+        self.renderScheduler = RenderScheduler(self)
+        self.renderScheduler.rendered.connect(self.showRendered)
+        self.renderScheduler.tilesRendered.connect(self.showTiles)
+        self.renderScheduler.failed.connect(self.showRenderError)
+        self.tileKey = None
+        self.deferRender = False
+        self.denoiseMode = 'bilateral'
+        self.denoiseBudget = 20.0
+
+        #   Presets are pre-rendered once the image has been idle for a moment, switching to one swaps pixmaps
+        self.presetCache = PresetCache()
+        self.presetTimer = QTimer(self)
+        self.presetTimer.setSingleShot(True)
+        self.presetTimer.setInterval(300)
+        self.presetTimer.timeout.connect(self.prerenderPresets)
         
         #   Menu Bar
         menu = self.menuBar()
@@ -39,6 +170,25 @@ class MainWindow(QMainWindow):
         openButton.setStatusTip('Open a file')
         openButton.triggered.connect(self.openFile)
         fileMenu.addAction(openButton)
+
+        #   Open Series Button
+        openSeriesButton = QAction('Open DICOM &Series', self)
+        openSeriesButton.setStatusTip('Open a folder of DICOM slices')
+        openSeriesButton.triggered.connect(self.openSeries)
+        fileMenu.addAction(openSeriesButton)
+
+        #   Worklist navigation
+        nextButton = QAction('&Next Image', self)
+        nextButton.setShortcut('Ctrl+Right')
+        nextButton.setStatusTip('Open the next file in the folder')
+        nextButton.triggered.connect(lambda: self.stepImage(1))
+        fileMenu.addAction(nextButton)
+
+        previousButton = QAction('&Previous Image', self)
+        previousButton.setShortcut('Ctrl+Left')
+        previousButton.setStatusTip('Open the previous file in the folder')
+        previousButton.triggered.connect(lambda: self.stepImage(-1))
+        fileMenu.addAction(previousButton)
         fileMenu.addSeparator()
 
         #   Save Button
@@ -56,6 +206,34 @@ class MainWindow(QMainWindow):
 
         #   Edit Button
         editMenu = menu.addMenu('&Edit')
+
+        #   Timings: spans are only recorded while the readout is on
+        timingsButton = QAction('Show &Timings', self)
+        timingsButton.setCheckable(True)
+        timingsButton.setStatusTip('Show rolling p50/p95 timings in the status bar')
+        timingsButton.toggled.connect(self.showTimings)
+        editMenu.addAction(timingsButton)
+
+        dumpTimingsButton = QAction('&Dump Timings...', self)
+        dumpTimingsButton.setStatusTip('Save the recorded timings as JSON')
+        dumpTimingsButton.triggered.connect(self.dumpTimings)
+        editMenu.addAction(dumpTimingsButton)
+
+        self.timingsTimer = QTimer(self)
+        self.timingsTimer.setInterval(1000)
+        self.timingsTimer.timeout.connect(self.updateTimings)
+        
+        #   View Menu
+        viewMenu = menu.addMenu('&View')
+        layoutGroup = QActionGroup(self)
+        for rows, cols in ((1, 1), (1, 2), (2, 2)):
+            layoutButton = QAction(f'{rows} x {cols} Viewports', self)
+            layoutButton.setCheckable(True)
+            layoutButton.setChecked((rows, cols) == (1, 1))
+            layoutButton.setStatusTip('Show the image in synchronized viewports with their own windows')
+            layoutButton.triggered.connect(lambda checked, rows=rows, cols=cols: self.setViewportLayout(rows, cols))
+            layoutGroup.addAction(layoutButton)
+            viewMenu.addAction(layoutButton)
         
         #   Help Button
         helpMenu = menu.addMenu('&Help')
@@ -228,6 +406,10 @@ class MainWindow(QMainWindow):
 
         self.imageDisplay = AnnotatableImageDisplay('Image Placeholder')
         self.imageDisplay.labelDialog.labelAdded.connect(self.updateLabelContainer)
+        self.imageDisplay.sliceStepped.connect(self.stepSlice)
+        self.imageDisplay.roiSelected.connect(self.roiWindow)
+        self.imageDisplay.viewChanged.connect(self.requestTiles)
+        self.imageDisplay.paintChanged.connect(self.showPaintMemory)
         self.imageDisplay.setSelectionMode()
         self.imageDisplay.setStyleSheet('''
         background-color: #2c2f33;
@@ -237,7 +419,12 @@ class MainWindow(QMainWindow):
         self.imageDisplay.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
         self.imageLayout = QVBoxLayout()
         self.imageLayout.addWidget(self.imageTitle)
-        self.imageLayout.addWidget(self.imageDisplay)
+        self.viewportGrid = QGridLayout()
+        self.viewportGrid.setSpacing(4)
+        self.viewportGrid.addWidget(self.imageDisplay, 0, 0)
+        self.imageLayout.addLayout(self.viewportGrid)
+        self.viewportPanels = []
+        self.viewportSide = None
 
         #   Labels container 
 
@@ -352,8 +539,30 @@ class MainWindow(QMainWindow):
         self.fieldsContainerLayout.addWidget(self.wwField)
         self.fieldsContainer.setLayout(self.fieldsContainerLayout)
 
+        #   Auto window from the histogram percentiles
+        self.autoWindowButton = QPushButton('Auto Window')
+        self.autoWindowButton.setStyleSheet('''
+            background-color: #7289da;
+            border-radius: 6px;
+            padding: 5px 10px;
+            color: #ffffff;
+        ''')
+        self.autoWindowButton.clicked.connect(self.autoWindow)
+
+        #   Window from a rectangle drawn on the image
+        self.roiWindowButton = QPushButton('Window From ROI')
+        self.roiWindowButton.setStyleSheet('''
+            background-color: #7289da;
+            border-radius: 6px;
+            padding: 5px 10px;
+            color: #ffffff;
+        ''')
+        self.roiWindowButton.clicked.connect(self.enableRoiMode)
+
         self.fieldsLayout.addWidget(self.fieldsTitle)
         self.fieldsLayout.addWidget(self.fieldsContainer)
+        self.fieldsLayout.addWidget(self.autoWindowButton)
+        self.fieldsLayout.addWidget(self.roiWindowButton)
 
         self.rightLayout.addLayout(self.fieldsLayout)
         self.rightLayout.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
@@ -403,21 +612,33 @@ class MainWindow(QMainWindow):
             border-radius: 5px;
         ''')
 
-        self.presetComboBox.addItem('Head & Neck: Brain')
-        self.presetComboBox.addItem('Head & Neck: Subdural')
-        self.presetComboBox.addItem('Head & Neck: Temporal Bones')
-        self.presetComboBox.addItem('Head & Neck: Soft Tissues')
-        self.presetComboBox.addItem('Head & Neck: Stroke')
-        self.presetComboBox.addItem('Chest: Lung')
-        self.presetComboBox.addItem('Chest: Mediastinum')
-        self.presetComboBox.addItem('Abdomen: Soft Tissues')
-        self.presetComboBox.addItem('Abdomen: Liver')
-        self.presetComboBox.addItem('Spine: Soft Tissues')
-        self.presetComboBox.addItem('Spine: Bone')
+        for preset in WINDOW_PRESETS:
+            self.presetComboBox.addItem(preset['name'], preset)
 
         self.presetComboBox.currentIndexChanged.connect(self.presetChanged)
 
         self.presetLayout.addWidget(self.presetComboBox)
+
+        #   Denoise filter, kept for the whole session
+        self.denoiseLabel = QLabel('Denoise:', self)
+        self.denoiseLabel.setStyleSheet('''
+            color: #ffffff;
+        ''')
+        self.presetLayout.addWidget(self.denoiseLabel)
+
+        self.denoiseComboBox = QComboBox(self)
+        self.denoiseComboBox.setStyleSheet('''
+            color: #ffffff;
+            border: 2px solid #7289da;
+            font-weight: bold;
+            border-radius: 5px;
+        ''')
+        self.denoiseComboBox.addItem('Bilateral', 'bilateral')
+        self.denoiseComboBox.addItem('Guided', 'guided')
+        self.denoiseComboBox.addItem('None', 'none')
+        self.denoiseComboBox.addItem('Auto (fits latency budget)', 'auto')
+        self.denoiseComboBox.currentIndexChanged.connect(self.denoiseChanged)
+        self.presetLayout.addWidget(self.denoiseComboBox)
         self.rightLayout.addWidget(self.presetWidget)
 
         mainLayout.addWidget(self.rightPanel)
@@ -445,37 +666,60 @@ class MainWindow(QMainWindow):
         mainLayout.setSpacing(20)
         mainLayout.setContentsMargins(10, 10, 10, 10)
 
+    @property
+    def imageArray(self):
+        #   The raw pixels live only in the loader, the window never keeps its own copy
+        return None if self.dicomLoader is None else self.dicomLoader.data
+
     def displayImage(self, imageArray):
 
-        fig, ax = plt.subplots(figsize = (5, 5))
-        
-        ax.imshow(imageArray, cmap='gray', aspect='auto')
-        
-        ax.axis('off')
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-        
-        fig.canvas.draw()
-        
-        width, height = fig.canvas.get_width_height()
-        image = np.frombuffer(fig.canvas.tostring_rgb(), dtype='uint8').reshape(height, width, 3)
-        qImage = QImage(image.data, width, height, QImage.Format.Format_RGB888)
-        
-        qPixmap = QPixmap.fromImage(qImage)
-        
-        #   Scale QPixmap if necessary: for save we need this ratio
-        labelHeight = self.imageDisplay.height()
-        scaledPixmap = qPixmap.scaledToHeight(labelHeight, Qt.TransformationMode.SmoothTransformation)
-        imgW = scaledPixmap.width()
-        self.dicomSaver.dspImgW= imgW
-        
-        self.imageDisplay.setPixmap(scaledPixmap)
-        
-        plt.close(fig)
+        #   Scale once to the (square) label: for save we need this ratio
+        self.showImage(toQImage(imageArray, self.imageDisplay.height()))
+
+    def showImage(self, qImage):
+        #   Annotations and exports use the 1x1 display size whatever the viewport layout
+        if self.imageDisplay.baseSize is None:
+            self.imageDisplay.baseSize = qImage.width()
+        self.dicomSaver.dspImgW = self.imageDisplay.baseSide()
+        if self.tileKey != self.currentTileKey():
+            self.imageDisplay.setTiles(None)
+        self.imageDisplay.setPixmap(QPixmap.fromImage(qImage))
+
+    def currentTileKey(self):
+        if self.dicomLoader is None:
+            return None
+        return (self.dicomLoader, self.dicomLoader.sliceIndex, self.windowWc, self.windowWw, self.denoiseMode)
+
+    def requestTiles(self):
+        #   Zoomed views get the visible tiles at full quality, cached ones come straight back
+        if self.dicomLoader is not None and self.imageDisplay.viewRegion() is not None:
+            self.renderWindowed()
+
+    def showTiles(self, tiles, request):
+        loader, wc, ww, height, preview, viewport, plane = request
+        if (loader is self.dicomLoader and (wc, ww) == (self.windowWc, self.windowWw)
+                and plane == (loader.dataKey, loader.sliceIndex)):
+            self.tileKey = self.currentTileKey()
+            self.imageDisplay.setTiles(tiles)
+
+    def showRendered(self, qImage, request):
+        #   Back on the GUI thread, results for an image that was closed or a slice that was left
+        #   meanwhile are dropped
+        loader, wc, ww, height, preview, viewport, plane = request
+        if not preview and (wc, ww) != (self.windowWc, self.windowWw):
+            return
+        if loader is self.dicomLoader and plane == (loader.dataKey, loader.sliceIndex):
+            self.showImage(qImage)
+            if not preview:
+                self.prefetchSlices(reset=True)
+
+    def showRenderError(self, message, request):
+        self.statusBar.showMessage(f'Render failed: {message}')
 
     def openFile(self):
 
         fileDialog = QFileDialog()
-        filePath, _ = fileDialog.getOpenFileName(self, 'Open Medical File', '', 'DICOM Files (*.dcm);;NIfTI Files (*.nii);;JPEG Files (*.jpg);;All Files (*)')
+        filePath, _ = fileDialog.getOpenFileName(self, 'Open Medical File', '', 'DICOM Files (*.dcm);;NIfTI Files (*.nii *.nii.gz);;JPEG Files (*.jpg);;All Files (*)')
 
         self.loadPath = filePath
         if filePath:
@@ -483,35 +727,179 @@ class MainWindow(QMainWindow):
             _, fileExtension = os.path.splitext(filePath)
             if fileExtension.lower() == '.dcm':
 
-                self.dicomLoader = DicomLoader()
-                self.imageArray, dicomData, wc, ww = self.dicomLoader.di2num(filePath = filePath)
-                imageArray = self.dicomLoader.display(data = self.imageArray)
-
-                if wc is not None and ww is not None:
-                    self.updateWs(wc, ww)
-
-                if imageArray is not None:
-                    self.displayImage(imageArray)
-                    self.dicomSaver.actImgW = self.imageArray.shape[0]
-                    self.dicomSaver.updateTr()
-
-                #elif fileExtension.lower() == '.nii':
-                #    print('This is a NIfTI file.')
-
-                #    imageArray, niiData = ni2num(filePath)
-
-                #    if imageArray is not None:
-                #        self.displayImage(imageArray)
-
-
+                folder = os.path.dirname(filePath)
+                self.worklist = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                                       if name.lower().endswith('.dcm'))
+                self.worklistIndex = self.worklist.index(filePath) if filePath in self.worklist else 0
+                self.filePrefetcher.setItems(self.worklist)
+                self.loadDicomFile(filePath)
+
+            elif fileExtension.lower() == '.nii' or filePath.lower().endswith('.nii.gz'):
+
+                self.filePrefetcher.setItems([])
+                self.dicomLoader = NiftiLoader()
+                _, niiData, wc, ww = self.dicomLoader.ni2num(filePath)
+                self.imageString = os.path.basename(filePath)
+                self.showLoadedImage(wc, ww)
+
+    def openSeries(self):
+
+        folder = QFileDialog.getExistingDirectory(self, 'Open DICOM Series')
+        if not folder:
+            return
+
+        series = groupSeries(scanDirectory(folder))
+        if not series:
+            QMessageBox.warning(self, 'Open Error', 'No DICOM files found in this folder.', QMessageBox.StandardButton.Ok)
+            return
+
+        #   The folder may hold several series (scouts, recons), open the largest one
+        headers = max(series.values(), key=len)
+        self.loadPath = headers[0]['path']
+        self.fileLoadedFlag = True
+        self.filePrefetcher.setItems([])
+        self.dicomLoader = DicomLoader()
+        _, dicomData, wc, ww = self.dicomLoader.loadSeries(headers)
+        self.imageString = os.path.basename(folder)
+        self.showLoadedImage(wc, ww)
+        if len(series) > 1:
+            self.statusBar.showMessage(f'{len(series)} series in folder, showing the largest ({len(headers)} slices)')
+
+    def loadDicomFile(self, filePath):
+        #   A prefetched loader is already decoded and rendered at its stored window
+        loader = self.filePrefetcher.get(filePath)
+        if loader is None:
+            loader = DicomLoader()
+            loader.di2num(filePath = filePath)
+        self.dicomLoader = loader
         self.imageString = os.path.basename(filePath)
-        self.imageTitle.setText(self.imageString)
+        self.showLoadedImage(loader.wc, loader.ww)
+        #   Widgets are read here on the GUI thread, the prefetch workers only see this snapshot
+        self.prefetchSettings = (self.imageDisplay.height(), self.denoiseMode, self.denoiseBudget)
+        self.filePrefetcher.moveTo(self.worklistIndex)
+
+    def prefetchFile(self, filePath):
+        #   Runs on the prefetch pool
+        targetSize, denoise, latencyBudget = self.prefetchSettings
+        loader = DicomLoader()
+        loader.di2num(filePath = filePath)
+        loader.targetSize = targetSize
+        loader.denoise, loader.latencyBudget = denoise, latencyBudget
+        loader.display(data = loader.data)
+        return loader
+
+    def stepImage(self, step):
+        index = self.worklistIndex + step
+        if self.worklist and 0 <= index < len(self.worklist):
+            self.worklistIndex = index
+            self.loadPath = self.worklist[index]
+            self.loadDicomFile(self.loadPath)
+
+    def prefetchSlices(self, reset=False):
+        if self.slicePrefetcher is not None:
+            if reset:
+                self.slicePrefetcher.clear()
+            self.slicePrefetcher.moveTo(self.dicomLoader.sliceIndex)
+
+    def showLoadedImage(self, wc, ww):
+        if self.slicePrefetcher is not None:
+            self.slicePrefetcher.close()
+            self.slicePrefetcher = None
+        if self.dicomLoader.sliceCount > 1:
+            self.slicePrefetcher = Prefetcher(self.dicomLoader.renderSlice, lookAhead=3, lookBehind=3)
+            self.slicePrefetcher.setItems(range(self.dicomLoader.sliceCount))
+
+        #   No window in the header, the fields and the slider start from the histogram
+        if self.dicomLoader.wc is None or self.dicomLoader.ww is None:
+            self.dicomLoader.wc, self.dicomLoader.ww = wc, ww = self.dicomLoader.autoWindow()
+
+        #   Large images are rendered from the pyramid level that matches the label
+        self.renderScheduler.clearCache()
+        self.imageDisplay.resetView()
+        self.dicomLoader.targetSize = self.imageDisplay.height()
+        self.dicomLoader.denoise = self.denoiseMode
+        self.dicomLoader.latencyBudget = self.denoiseBudget
+        imageArray = self.dicomLoader.display(data = self.imageArray)
+
+        self.windowWc = self.dicomLoader.wc
+        self.windowWw = self.dicomLoader.ww
+        if wc is not None and ww is not None:
+            self.updateWs(wc, ww)
+
+        if imageArray is not None:
+            self.displayImage(imageArray)
+            self.dicomSaver.actImgW = self.imageArray.shape[0]
+            self.dicomSaver.updateTr()
+
+        self.updateImageTitle()
         self.fltMin = self.dicomLoader.dataMin
         self.fltMax = self.dicomLoader.dataMax
         self.windowSlider.imageLoaded = True
         self.translateRatio = self.translateRatioFinder(self.fltMin, self.fltMax)
         self.windowSlider.stringMax = str(f'{self.dicomLoader.dataMax:.1f}')
         self.windowSlider.stringMin = str(f'{self.dicomLoader.dataMin:.1f}')
+        self.windowSlider.setHistogram(self.dicomLoader.histogramStats()[0])
+        self.prefetchSlices()
+        self.imageChanged()
+        for panel in self.viewportPanels:
+            panel.setLoader(self.dicomLoader)
+
+    def setViewportLayout(self, rows, cols):
+        #   Square cells that fit where the single display was, the main display stays top left
+        if self.viewportSide is None:
+            self.viewportSide = self.imageDisplay.height()
+            if self.imageDisplay.baseSize is None:
+                self.imageDisplay.baseSize = self.viewportSide
+        side, spacing = self.viewportSide, self.viewportGrid.spacing()
+        count = rows * cols
+        if count == 1:
+            cell = side
+        else:
+            comboHeight = 26
+            cell = min((side - spacing * (cols - 1)) // cols, (side - spacing * (rows - 1)) // rows - comboHeight)
+
+        while len(self.viewportPanels) > count - 1:
+            panel = self.viewportPanels.pop()
+            self.viewportGrid.removeWidget(panel)
+            panel.stop()
+            panel.deleteLater()
+        defaults = [6, 10, 0]
+        while len(self.viewportPanels) < count - 1:
+            panel = ViewportPanel(self.imageDisplay, defaults[len(self.viewportPanels) % len(defaults)])
+            panel.renderScheduler.failed.connect(self.showRenderError)
+            self.viewportPanels.append(panel)
+
+        self.imageDisplay.setFixedSize(cell, cell)
+        for index, panel in enumerate(self.viewportPanels, start=1):
+            self.viewportGrid.removeWidget(panel)
+            self.viewportGrid.addWidget(panel, index // cols, index % cols)
+            panel.imageDisplay.setFixedSize(cell, cell)
+            panel.imageDisplay.syncView(self.imageDisplay)
+        self.viewportGrid.setAlignment(Qt.AlignmentFlag.AlignTop | Qt.AlignmentFlag.AlignLeft)
+        self.imageDisplay.update()
+
+        if self.dicomLoader is not None:
+            self.renderWindowed()
+            self.imageChanged()
+            for panel in self.viewportPanels:
+                panel.setLoader(self.dicomLoader)
+
+    def updateImageTitle(self):
+        title = self.imageString
+        if self.dicomLoader.sliceCount > 1:
+            title += f'  [{self.dicomLoader.sliceIndex + 1}/{self.dicomLoader.sliceCount}]'
+        self.imageTitle.setText(title)
+
+    def stepSlice(self, step):
+        if self.dicomLoader is not None and self.dicomLoader.sliceCount > 1:
+            self.dicomLoader.setSlice(self.dicomLoader.sliceIndex + step)
+            self.displayImage(self.dicomLoader.display(self.imageArray))
+            self.updateImageTitle()
+            self.prefetchSlices()
+            self.imageChanged()
+            self.requestTiles()
+            for panel in self.viewportPanels:
+                panel.render()
 
     def translateRatioFinder(self, fltMin, fltMax):
         tr = float((fltMax - fltMin) // 277)
@@ -539,10 +927,8 @@ class MainWindow(QMainWindow):
                 self.windowSlider.wcField = wc
                 self.windowSlider.reverseKnobLocationUpdate()
                 if self.dicomLoader.dataMin < wc < self.dicomLoader.dataMax:
-                    newData = self.dicomLoader.setWC(to = wc)
-                    newImgArr = self.dicomLoader.display(newData)
-                    print(newImgArr)
-                    self.displayImage(newImgArr)
+                    self.windowWc = wc
+                    self.renderWindowed(self.previewRender)
                 else:
                     wc = self.dicomLoader.wc
                     self.update()
@@ -552,10 +938,11 @@ class MainWindow(QMainWindow):
         if self.dicomLoader is not None:
             wc = self.windowSlider.newWc
             wc = int(wc)
-            print('new wc is:', wc)
             self.wcField.setText(str(wc))
             self.dicomLoader.firstLoadFlag = False
+            self.previewRender = True
             self.updateActualWC()
+            self.previewRender = False
 
     def updateWWSlider(self):
         if self.dicomLoader is not None:
@@ -563,7 +950,9 @@ class MainWindow(QMainWindow):
             ww = int(ww)
             self.wwField.setText(str(ww))
             self.dicomLoader.firstLoadFlag = False
+            self.previewRender = True
             self.updateActualWW()
+            self.previewRender = False
                 
     def wwFieldUpdatesSlider(self):
         if self.dicomLoader is not None:
@@ -580,74 +969,92 @@ class MainWindow(QMainWindow):
         ww = int(self.wwField.text())
         self.dicomLoader.firstLoadFlag = False
         if type(ww) == int and self.dicomLoader is not None:
-            if self.dicomLoader.dataMin < ww < self.dicomLoader.dataMax:
-                newData = self.dicomLoader.setWW(to = ww)
-                newImgArr = self.dicomLoader.display(newData)
-                print(newImgArr)
-                self.displayImage(newImgArr)
+            if 0 < ww <= self.dicomLoader.dataMax - self.dicomLoader.dataMin:
+                self.windowWw = ww
+                self.renderWindowed(self.previewRender)
             else:
                 wc = self.dicomLoader.wc
                 self.update()
 
+    def renderWindowed(self, preview=False):
+        #   Previews restart the settle timer, the full-quality render follows when input stops
+        if self.deferRender or self.windowWc is None or self.windowWw is None:
+            return
+        self.renderScheduler.request(self.dicomLoader, self.windowWc, self.windowWw,
+                                     self.imageDisplay.height(), preview, self.imageDisplay.viewRegion())
+        if preview:
+            self.settleTimer.start()
+        else:
+            self.settleTimer.stop()
+
+    def applyWindow(self, wc, ww, image=None):
+        #   Sets both fields and validates them like a manual edit, then renders once,
+        #   or shows image if it was already rendered for exactly this window
+        self.wcField.setText(str(wc))
+        self.wwField.setText(str(ww))
+        self.deferRender = True
+        self.updateActualWC()
+        self.updateActualWW()
+        self.deferRender = False
+        if image is not None and (self.windowWc, self.windowWw) == (wc, ww):
+            self.settleTimer.stop()
+            with self.dicomLoader.lock:
+                self.dicomLoader.wc = wc
+                self.dicomLoader.ww = ww
+                self.dicomLoader.firstLoadFlag = False
+            self.showImage(image)
+            self.prefetchSlices(reset=True)
+            self.requestTiles()
+        else:
+            self.renderWindowed()
+
+    def autoWindow(self):
+        if self.dicomLoader is not None:
+            wc, ww = self.dicomLoader.autoWindow()
+            self.applyWindow(wc, ww)
+
+    def enableRoiMode(self):
+        if self.dicomLoader is not None:
+            self.imageDisplay.setRoiMode()
+
+    def roiWindow(self, x1, y1, x2, y2):
+        #   Display -> raw pixel coordinates with the same ratio DicomSaver exports with
+        if self.dicomLoader is None or self.dicomSaver.tr is None:
+            return
+        x1, y1, x2, y2 = [math.floor(v * self.dicomSaver.tr) for v in (x1, y1, x2, y2)]
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
+        rows, cols = self.imageArray.shape
+        x1, x2 = max(0, x1), min(cols - 1, x2)
+        y1, y2 = max(0, y1), min(rows - 1, y2)
+        if x1 <= x2 and y1 <= y2:
+            wc, ww = self.dicomLoader.roiWindow(x1, y1, x2, y2)
+            self.applyWindow(wc, ww)
+
+    def denoiseChanged(self):
+        self.denoiseMode = self.denoiseComboBox.currentData()
+        if self.dicomLoader is not None:
+            with self.dicomLoader.lock:
+                self.dicomLoader.denoise = self.denoiseMode
+            self.renderWindowed()
+            self.imageChanged()
+            for panel in self.viewportPanels:
+                panel.render()
+
     def presetChanged(self):
+        preset = self.presetComboBox.currentData()
+        if self.fileLoadedFlag and preset is not None:
+            image = self.presetCache.get(self.dicomLoader, preset['wc'], preset['ww'], self.imageDisplay.height())
+            self.applyWindow(preset['wc'], preset['ww'], image)
+
+    def imageChanged(self):
+        #   Pre-rendered presets belong to one image, slice and denoise mode
+        self.presetCache.clear()
+        self.presetTimer.start()
 
-        selectedOption = self.presetComboBox.currentText()
-        if self.fileLoadedFlag:
-            if selectedOption == 'Head & Neck: Brain':
-                self.wcField.setText('40')
-                self.wwField.setText('80')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Head & Neck: Subdural':
-                self.wcField.setText('75')
-                self.wwField.setText('215')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Head & Neck: Temporal Bones':
-                self.wcField.setText('600')
-                self.wwField.setText('2800')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Head & Neck: Soft Tissues':
-                self.wcField.setText('50')
-                self.wwField.setText('350')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Head & Neck: Stroke':
-                self.wcField.setText('40')
-                self.wwField.setText('40')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Chest: Lung':
-                self.wcField.setText('-600')
-                self.wwField.setText('1500')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Chest: Mediastinum':
-                self.wcField.setText('50')
-                self.wwField.setText('350')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Abdomen: Soft Tissues':
-                self.wcField.setText('50')
-                self.wwField.setText('400')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Abdomen: Liver':
-                self.wcField.setText('70')
-                self.wwField.setText('150')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Spine: Soft Tissues':
-                self.wcField.setText('50')
-                self.wwField.setText('250')
-                self.updateActualWC()
-                self.updateActualWW()
-            elif selectedOption == 'Spine: Bone':
-                self.wcField.setText('400')
-                self.wwField.setText('1800')
-                self.updateActualWC()
-                self.updateActualWW()
+    def prerenderPresets(self):
+        if self.dicomLoader is not None:
+            self.presetCache.prerender(self.dicomLoader, WINDOW_PRESETS, self.imageDisplay.height())
 
     def updateLabelContainer(self, labelName, labelColor):
         #   Makes a new label card
@@ -673,35 +1080,32 @@ class MainWindow(QMainWindow):
             if not self.imageDisplay.isEmpty:
                 if t == 'Numpy File (Masks) (*.npy)':
                     if self.imageDisplay.shape == 'rectangle':
-                        self.dicomSaver.rect2npy(filePath, self.imageArray, self.imageDisplay.annotations)
+                        self.dicomSaver.rect2npy(filePath, self.imageArray, self.imageDisplay.store)
                     elif self.imageDisplay.shape == 'polygon':
-                        self.dicomSaver.poly2npy(filePath, self.imageArray, self.imageDisplay.polygonPoints, self.imageDisplay.currentLabelName)
+                        self.dicomSaver.poly2npy(filePath, self.imageArray, self.imageDisplay.store)
                     elif self.imageDisplay.shape == 'paint':
                         self.dicomSaver.paint2npy(filePath, self.imageArray, self.imageDisplay.paintLayers)
 
                 elif t == 'CSV File (Masks) (*.csv)':
                     if self.imageDisplay.shape == 'rectangle':
-                        self.dicomSaver.rect2csv(filePath, self.imageArray, self.imageDisplay.annotations, self.loadPath)
+                        self.dicomSaver.rect2csv(filePath, self.imageArray, self.imageDisplay.store, self.loadPath)
                     elif self.imageDisplay.shape == 'polygon':
-                        self.dicomSaver.poly2csv(filePath, self.imageArray, self.imageDisplay.polygonPoints,
-                                                 self.imageDisplay.currentLabelName, self.loadPath)
+                        self.dicomSaver.poly2csv(filePath, self.imageArray, self.imageDisplay.store, self.loadPath)
                     elif self.imageDisplay.shape == 'paint':
                         QMessageBox.warning(self, 'Save Error', "CSV export for paint is not available.", QMessageBox.StandardButton.Ok)
 
                 elif t == 'JSON File(COCO Formatting) (*.json)':
                     if self.imageDisplay.shape == 'rectangle':
-                        self.dicomSaver.rect2json(filePath, self.imageArray, self.imageDisplay.annotations, self.loadPath)
+                        self.dicomSaver.rect2json(filePath, self.imageArray, self.imageDisplay.store, self.loadPath)
                     elif self.imageDisplay.shape == 'polygon':
-                        self.dicomSaver.poly2json(filePath, self.imageArray, self.imageDisplay.polygonPoints,
-                                                  self.imageDisplay.currentLabelName, self.loadPath)
+                        self.dicomSaver.poly2json(filePath, self.imageArray, self.imageDisplay.store, self.loadPath)
                     elif self.imageDisplay.shape == 'paint':
                         QMessageBox.warning(self, 'Save Error', "JSON export for paint is not available.", QMessageBox.StandardButton.Ok)
                 elif t == 'NIfTI File(Masks) (*.nii.gz)':
                     if self.imageDisplay.shape == 'rectangle':
-                        self.dicomSaver.rect2nii(filePath, self.imageArray, self.imageDisplay.annotations)
+                        self.dicomSaver.rect2nii(filePath, self.imageArray, self.imageDisplay.store)
                     elif self.imageDisplay.shape == 'polygon':
-                        self.dicomSaver.poly2nii(filePath, self.imageArray, self.imageDisplay.polygonPoints,
-                                                  self.imageDisplay.currentLabelName)
+                        self.dicomSaver.poly2nii(filePath, self.imageArray, self.imageDisplay.store)
                     elif self.imageDisplay.shape == 'paint':
                         self.dicomSaver.paint2nii(filePath, self.imageArray, self.imageDisplay.paintLayers)
 
@@ -724,5 +1128,42 @@ class MainWindow(QMainWindow):
     def enableClearMode(self):
         self.imageDisplay.setClearMode()
 
+    def showTimings(self, enabled):
+        registry.enabled = enabled
+        if enabled:
+            self.timingsTimer.start()
+        else:
+            self.timingsTimer.stop()
+            self.statusBar.clearMessage()
+
+    def updateTimings(self):
+        #   p50/p95 in ms of the slowest spans
+        summary = registry.summary()
+        if summary:
+            self.statusBar.showMessage(summary)
+
+    def dumpTimings(self):
+        filePath, _ = QFileDialog.getSaveFileName(self, 'Dump Timings', 'timings.json', 'JSON Files (*.json)')
+        if filePath:
+            registry.dump(filePath)
+
+    def showPaintMemory(self):
+        layers = self.imageDisplay.paintMemory()
+        if layers:
+            self.statusBar.showMessage('Paint: ' + '  '.join(f'{label} {size / 1024:.0f} KiB ({tiles} tiles)'
+                                                              for label, size, tiles in layers))
+
     def exitProgram(self):
         self.close()
+
+    def closeEvent(self, event):
+        self.timingsTimer.stop()
+        self.renderScheduler.stop()
+        for panel in self.viewportPanels:
+            panel.stop()
+        self.presetTimer.stop()
+        self.presetCache.close()
+        self.filePrefetcher.close()
+        if self.slicePrefetcher is not None:
+            self.slicePrefetcher.close()
+        super().closeEvent(event)
@@ -1,85 +1,740 @@
 # Functions for loading DICOM and NIfTI images
 
-import cv2
-import copy
-import pydicom
+#   cv2, pydicom and nibabel are imported inside the functions that use them so startup only pays for NumPy
+
+import os
+import math
+import time
+import itertools
+import tempfile
+import threading
 import numpy as np
-import nibabel as nib
-from PyQt6.QtWidgets import QFileDialog
-from pydicom.pixel_data_handlers.util import apply_voi_lut
-from scipy import ndimage
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import timed
+
+#   Identifies a loader in render caches, unlike id() it is never handed to a later loader
+loaderTokens = itertools.count()
+
+def windowValue(value):
+    import pydicom
+    if isinstance(value, pydicom.multival.MultiValue):
+        return int(str(value[0]).lstrip('0'))
+    return value
+
+def headerInfo(dicom, filePath):
+    #   Metadata needed for triage and series sorting, nothing here touches PixelData
+    def floats(value):
+        return None if value is None else [float(v) for v in value]
+
+    instanceNumber = dicom.get('InstanceNumber')
+
+    return {
+        'path': filePath,
+        'wc': windowValue(dicom.get('WindowCenter')),
+        'ww': windowValue(dicom.get('WindowWidth')),
+        'rows': dicom.get('Rows'),
+        'cols': dicom.get('Columns'),
+        'pixelSpacing': floats(dicom.get('PixelSpacing')),
+        'seriesUid': dicom.get('SeriesInstanceUID'),
+        'instanceUid': dicom.get('SOPInstanceUID'),
+        'instanceNumber': None if instanceNumber is None else int(instanceNumber),
+        'position': floats(dicom.get('ImagePositionPatient')),
+        'orientation': floats(dicom.get('ImageOrientationPatient')),
+        'rescale': (float(dicom.get('RescaleSlope', 1)), float(dicom.get('RescaleIntercept', 0))),
+    }
+
+def readHeader(filePath):
+    import pydicom
+    dicom = pydicom.dcmread(filePath, stop_before_pixels=True, defer_size='1 KB')
+    return headerInfo(dicom, filePath)
+
+def scanDirectory(folder, maxWorkers=None):
+    #   Header-only scan of every .dcm file in a folder on a thread pool (pydicom
+    #   spends most of its time in file I/O), unreadable files are skipped
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                   if name.lower().endswith('.dcm'))
+
+    def tryRead(path):
+        import pydicom
+        try:
+            return readHeader(path)
+        except (OSError, pydicom.errors.InvalidDicomError):
+            return None
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+        headers = list(pool.map(tryRead, paths))
+    return [header for header in headers if header is not None]
+
+def sliceNormal(orientation):
+    #   Cross product of the ImageOrientationPatient row and column direction cosines
+    rx, ry, rz, cx, cy, cz = orientation
+    return (ry * cz - rz * cy, rz * cx - rx * cz, rx * cy - ry * cx)
+
+def groupSeries(headers):
+    #   SeriesInstanceUID -> headers sorted along the slice axis: ImagePositionPatient projected on
+    #   the slice normal, so sagittal and coronal series sort too (z when there is no orientation,
+    #   InstanceNumber when there is no position)
+    series = {}
+    for header in headers:
+        series.setdefault(header['seriesUid'], []).append(header)
+    for headers in series.values():
+        orientation = next((header['orientation'] for header in headers
+                            if header['orientation'] and len(header['orientation']) == 6), None)
+        normal = sliceNormal(orientation) if orientation else (0.0, 0.0, 1.0)
+
+        def sliceOrder(header):
+            position = header['position']
+            distance = sum(p * n for p, n in zip(position, normal)) if position else 0.0
+            return (distance, header['instanceNumber'] or 0)
+
+        headers.sort(key=sliceOrder)
+    return series
 
 class DicomLoader:
-    def __init__(self):
+    def __init__(self, cacheSize=8, reuseBuffers=False, dtypePolicy='compact'):
         self.wc = None
         self.ww = None
         self.filePath = None
+        self.dicom = None
+        self.header = None
         self.data = None
+        self.volume = None
+        self.sliceIndex = 0
+        self.lock = threading.RLock()
+        self.token = next(loaderTokens)
+
+        #   'compact': raw pixels stay int16/uint16 with the modality rescale done in the
+        #   integer domain when that is lossless, float data is float32.
+        #   'legacy': float64 from apply_voi_lut like before
+        self.dtypePolicy = dtypePolicy
         self.dataMax = None
         self.dataMin = None
         self.firstLoadFlag = True
 
-    def di2num(self, filePath):
-        dicom = pydicom.read_file(filePath)
-        self.wc = dicom.WindowCenter
-        self.ww = dicom.WindowWidth
+        #   Fixed-bin histogram over [dataMin, dataMax] and its cumulative fraction, built once per
+        #   image so auto-windowing is O(bins) and never touches the pixels again
+        self.histogramBins = 1024
+        self.histogram = None
+        self.histogramEdges = None
+        self.cdf = None
+        self.autoWindowPercentiles = (0.5, 99.5)
+        self.lut = None
+        self.lutKey = None
+
+        #   Display pipeline: every stage keeps a small LRU of outputs keyed by
+        #   the parameters of that stage and of every stage before it
+        self.dataKey = 0
+        self.cacheSize = cacheSize
+        self.bilateralParams = (9, 75, 75)
+        self.guidedParams = (4, 0.01, 2)
+        self.claheParams = (2.0, (8, 8))
+        self.stageCache = {'window': OrderedDict(), 'denoise': OrderedDict(),
+                           'gamma': OrderedDict(), 'clahe': OrderedDict()}
+
+        #   Buffer-reusing mode: the loader owns float32/uint8 work buffers for the
+        #   current image and every stage writes into them, the stage caches are skipped.
+        #   Opt-in for full-resolution rendering (scripts, batch work). The GUI leaves it off, slice
+        #   and file prefetch only help through the stage caches, and it renders from the pyramid
+        #   level that fits the label (about 5 MB per render for a 3000x3000 plane either way)
+        self.reuseBuffers = reuseBuffers
+        self.floatBuffer = None
+        self.byteBuffers = None
+        self.guidedScratch = {}
+
+        #   Denoise stage: 'bilateral', 'guided', 'none' or 'auto' (the best filter whose
+        #   measured time on the current plane size fits latencyBudget milliseconds)
+        self.denoise = 'bilateral'
+        self.latencyBudget = 20.0
+        self.denoiseTimings = {}
+
+        #   Multi-resolution pyramid per plane, the pipeline runs at the smallest
+        #   level that still covers targetSize (on-screen pixels times zoom)
+        self.targetSize = None
+        self.pyramidMinSize = 512
+        self.pyramids = OrderedDict()
+
+        #   Zoomed views render only the visible tileSize x tileSize tiles of the matching level
+        self.tileSize = 256
+        self.tileCacheSize = 64
+        self.tileCache = OrderedDict()
 
-        if isinstance(self.wc, pydicom.multival.MultiValue):
-            self.wc = int(str(self.wc[0]).lstrip('0'))
-        if isinstance(self.ww, pydicom.multival.MultiValue):
-            self.ww = int(str(self.ww[0]).lstrip('0'))
+    def loadHeader(self, filePath):
+        #   Large elements (PixelData) stay on disk until di2num actually needs them
+        import pydicom
+        self.filePath = filePath
+        self.dicom = pydicom.dcmread(filePath, defer_size='1 KB')
+        self.header = headerInfo(self.dicom, filePath)
+        self.wc = self.header['wc']
+        self.ww = self.header['ww']
+        return self.header
 
-        self.data = apply_voi_lut(dicom.pixel_array, dicom)
+    @timed('decode')
+    def di2num(self, filePath):
+        from pydicom.pixel_data_handlers.util import apply_voi_lut
+        if self.dicom is None or self.filePath != filePath:
+            self.loadHeader(filePath)
+        dicom = self.dicom
+
+        if self.dtypePolicy == 'legacy':
+            self.data = apply_voi_lut(dicom.pixel_array, dicom)
+        else:
+            self.data = self.rescaledPixels(dicom)
+        self.updateStats()
         return self.data, dicom, self.wc, self.ww
 
-    def applyWindowing(self, data):
-        dataMin = self.wc - self.ww / 2
-        dataMax = self.wc + self.ww / 2
+    @timed('decode.series')
+    def loadSeries(self, headers, memmap=False, maxWorkers=None):
+        #   Decodes a sorted series into one preallocated (optionally memory-mapped)
+        #   volume with modality rescale applied, self.data is a view of one slice
+        import pydicom
+        first = pydicom.dcmread(headers[0]['path'], stop_before_pixels=True)
+        self.filePath = headers[0]['path']
+        self.dicom = first
+        self.header = headers[0]
+        self.wc = headers[0]['wc']
+        self.ww = headers[0]['ww']
+
+        #   Slices may carry their own slope/intercept, float32 holds any mix of them
+        dtype = self.compactDtype(first)
+        if len({header['rescale'] for header in headers}) > 1:
+            dtype = np.dtype(np.float32)
+        shape = (len(headers), first.Rows, first.Columns)
+        if memmap:
+            self.volume = np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+        else:
+            self.volume = np.empty(shape, dtype=dtype)
+
+        def decode(i):
+            self.volume[i] = self.rescaledPixels(pydicom.dcmread(headers[i]['path']))
+            return self.volume[i].min().item(), self.volume[i].max().item()
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as pool:
+            ranges = list(pool.map(decode, range(len(headers))))
 
+        #   Per-slice ranges come for free from the decode, no extra pass over the volume
+        self.dataMin = min(low for low, _ in ranges)
+        self.dataMax = max(high for _, high in ranges)
+        self.sliceIndex = len(headers) // 2
+        self.data = self.volume[self.sliceIndex]
+        self.invalidate()
+        self.histogramStats()
+        return self.volume, first, self.wc, self.ww
+
+    def rescaledPixels(self, dicom):
+        #   Modality LUT (slope/intercept) in the dtype chosen by compactDtype, untouched
+        #   pixels are returned as decoded (no copy)
+        pixels = dicom.pixel_array
+        slope = float(dicom.get('RescaleSlope', 1))
+        intercept = float(dicom.get('RescaleIntercept', 0))
+        dtype = self.compactDtype(dicom, (int(pixels.min()), int(pixels.max())))
+        if dtype.kind == 'f':
+            return pixels * np.float32(slope) + np.float32(intercept)
+        if slope == 1 and intercept == 0 and pixels.dtype.kind in 'iu':
+            return pixels
+
+        rescaled = np.empty(pixels.shape, dtype=dtype)
+        np.copyto(rescaled, pixels.astype(np.int32) * int(slope) + int(intercept), casting='unsafe')
+        return rescaled
+
+    def compactDtype(self, dicom, storedRange=None):
+        #   int16 (or int32) when the rescale is integral and the rescaled range fits, float32
+        #   otherwise. Without the actual stored range the worst case from BitsStored is used
+        slope = float(dicom.get('RescaleSlope', 1))
+        intercept = float(dicom.get('RescaleIntercept', 0))
+        if not (slope.is_integer() and intercept.is_integer()):
+            return np.dtype(np.float32)
+
+        bits = dicom.get('BitsStored', 16)
+        if storedRange is not None:
+            low, high = storedRange
+        elif dicom.get('PixelRepresentation', 0):
+            low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+        else:
+            low, high = 0, (1 << bits) - 1
+        values = sorted((low * slope + intercept, high * slope + intercept))
+        for dtype in (np.int16, np.int32):
+            if np.iinfo(dtype).min <= values[0] and values[1] <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype(np.float32)
+
+    @property
+    def sliceCount(self):
+        return 1 if self.volume is None else self.volume.shape[0]
+
+    def setSlice(self, index):
+        #   Zero-copy view of the volume, stage caches are keyed by slice so they stay valid
+        with self.lock:
+            if self.volume is not None:
+                self.sliceIndex = max(0, min(index, self.sliceCount - 1))
+                self.data = self.volume[self.sliceIndex]
+            return self.data
+
+    def planeAt(self, index):
+        return self.data if self.volume is None else self.volume[index]
+
+    @property
+    def nbytes(self):
+        #   Decoded pixels plus everything held by the stage caches
+        total = self.volume.nbytes if self.volume is not None else getattr(self.data, 'nbytes', 0)
+        for cache in self.stageCache.values():
+            total += sum(result.nbytes for result in cache.values())
+        return total
+
+    def updateStats(self):
+        #   Once per loaded image, the pipeline and the slider read these back. Python numbers, so
+        #   range arithmetic on int16 data cannot wrap
+        self.dataMax = np.max(self.data).item()
+        self.dataMin = np.min(self.data).item()
+        self.invalidate()
+        self.histogramStats()
+        self.pyramid(self.data, self.sliceIndex)
+
+    def histogramStats(self):
+        #   Whole volume for series, the current plane otherwise (NIfTI rebuilds it when its range grows)
+        with self.lock:
+            if self.histogram is None:
+                values = self.volume if self.volume is not None else self.data
+                low, high = float(self.dataMin), float(self.dataMax)
+                self.histogram, self.histogramEdges = np.histogram(values, bins=self.histogramBins,
+                                                                   range=(low, max(high, low + 1)))
+                self.cdf = np.cumsum(self.histogram) / max(self.histogram.sum(), 1)
+            return self.histogram, self.histogramEdges, self.cdf
+
+    def autoWindow(self, percentiles=None):
+        #   WC/WW spanning the given percentiles of the cumulative histogram
+        _, edges, cdf = self.histogramStats()
+        return self.windowFromCdf(cdf, edges, percentiles)
+
+    def roiWindow(self, x1, y1, x2, y2, percentiles=None):
+        #   Same percentiles over a raw-pixel rectangle, one histogram pass over the ROI view
+        with self.lock:
+            roi = self.data[y1:y2 + 1, x1:x2 + 1]
+            low, high = float(self.dataMin), float(self.dataMax)
+            histogram, edges = np.histogram(roi, bins=self.histogramBins, range=(low, max(high, low + 1)))
+        cdf = np.cumsum(histogram) / max(histogram.sum(), 1)
+        return self.windowFromCdf(cdf, edges, percentiles)
+
+    def windowFromCdf(self, cdf, edges, percentiles=None):
+        low, high = percentiles or self.autoWindowPercentiles
+        first = int(np.searchsorted(cdf, low / 100))
+        last = min(int(np.searchsorted(cdf, high / 100)), len(cdf) - 1)
+        windowMin, windowMax = edges[first], edges[last + 1]
+        return int(round((windowMin + windowMax) / 2)), max(1, int(round(windowMax - windowMin)))
+
+    def invalidate(self):
+        self.dataKey += 1
+        self.histogram = None
+        self.pyramids.clear()
+        self.tileCache.clear()
+        for cache in self.stageCache.values():
+            cache.clear()
+
+    def pyramid(self, plane, sliceIndex):
+        #   Level 0 is the plane itself, each level halves it until it fits pyramidMinSize
+        import cv2
+        key = (self.dataKey, sliceIndex)
+        if key in self.pyramids:
+            self.pyramids.move_to_end(key)
+            return self.pyramids[key]
+
+        levels = [plane]
+        while max(levels[-1].shape) > self.pyramidMinSize:
+            level = levels[-1]
+            if level.dtype in (np.uint8, np.uint16, np.int16, np.float32, np.float64):
+                levels.append(cv2.pyrDown(level))
+            else:
+                levels.append(np.ascontiguousarray(level[::2, ::2]))
+
+        self.pyramids[key] = levels
+        if len(self.pyramids) > self.cacheSize:
+            self.pyramids.popitem(last=False)
+        return levels
+
+    def pyramidLevel(self, levels, targetSize=None):
+        #   Smallest level whose longest side still covers the target, full resolution without one
+        targetSize = targetSize or self.targetSize
+        if not targetSize:
+            return 0
+        level = 0
+        while level + 1 < len(levels) and max(levels[level + 1].shape) >= targetSize:
+            level += 1
+        return level
+
+    def windowBounds(self):
         if self.firstLoadFlag:
-            dataMin = self.dataMin
-            dataMax = self.dataMax
+            return self.dataMin, self.dataMax
+        return self.wc - self.ww / 2, self.wc + self.ww / 2
 
+    def applyWindowing(self, data):
+        dataMin, dataMax = self.windowBounds()
         return np.clip(data, dataMin, dataMax)
 
     def normalize(self, data):
-        return ((data - data.min()) / (data.max() - data.min()) * 255).astype(np.uint8)
+        #   Integer data is shifted in float64, int16 minus a -32768 padding value would wrap
+        low, high = data.min().item(), data.max().item()
+        if data.dtype.kind in 'iu':
+            data = data.astype(np.float64)
+        return ((data - low) / (high - low) * 255).astype(np.uint8)
+
+    def windowLut(self, data):
+        #   Table over the stored integer range that maps straight to display uint8,
+        #   built with applyWindowing + normalize so the result is bit for bit the same
+        key = (self.wc, self.ww, self.firstLoadFlag, self.dataMin, self.dataMax, data.dtype)
+        if self.lutKey == key:
+            return self.lut
+
+        values = np.arange(int(self.dataMin), int(self.dataMax) + 1, dtype=data.dtype)
+        mapped = self.normalize(self.applyWindowing(values))
+        if data.dtype.itemsize <= 2:
+            #   Full dtype sized table indexed by the unsigned view of the data
+            index = values.view(np.dtype(f'u{data.dtype.itemsize}'))
+            lut = np.zeros(1 << (8 * data.dtype.itemsize), dtype=np.uint8)
+            lut[index] = mapped
+        else:
+            lut = mapped
+
+        self.lut = lut
+        self.lutKey = key
+        return lut
+
+    def gather(self, lut, index, out=None, rows=256):
+        #   np.take casts the whole index array to intp, into a buffer we go a block of rows at a time
+        if out is None:
+            return np.take(lut, index)
+        for start in range(0, index.shape[0], rows):
+            np.take(lut, index[start:start + rows], out=out[start:start + rows], mode='clip')
+        return out
+
+    @timed('window')
+    def applyWindowingLut(self, data, out=None):
+        #   Windowing + normalize in one gather for integer data, float data takes the old path
+        if data.dtype.kind in 'iu':
+            if data.dtype.itemsize <= 2:
+                lut = self.windowLut(data)
+                return self.gather(lut, data.view(np.dtype(f'u{data.dtype.itemsize}')), out)
+            if int(self.dataMax) - int(self.dataMin) < (1 << 16):
+                lut = self.windowLut(data)
+                return np.take(lut, data - int(self.dataMin), out=out)
+
+        if out is None:
+            return self.normalize(self.applyWindowing(data))
+
+        #   Same maths in place on the float32 work buffer
+        work = self.floatBuffer
+        dataMin, dataMax = self.windowBounds()
+        np.clip(data, dataMin, dataMax, out=work)
+        workMin, workMax = work.min(), work.max()
+        np.subtract(work, workMin, out=work)
+        np.divide(work, workMax - workMin, out=work)
+        np.multiply(work, 255, out=work)
+        np.copyto(out, work, casting='unsafe')
+        return out
 
-    def applyClahe(self, data, clipLimit=2.0, tileGridSize=(8, 8)):
+    @timed('clahe')
+    def applyClahe(self, data, clipLimit=2.0, tileGridSize=(8, 8), out=None):
+        import cv2
         clahe = cv2.createCLAHE(clipLimit=clipLimit, tileGridSize=tileGridSize)
-        return clahe.apply(data)
+        return clahe.apply(data, dst=out)
 
-    def adaptiveGammaCorrection(self, data):
-        mean = np.mean(data)
+    @timed('gamma')
+    def adaptiveGammaCorrection(self, data, out=None, mean=None):
+        #   256 entry table, same values as np.power on the whole uint8 image. Tiles pass
+        #   the mean of the whole plane so they get the same curve
+        import cv2
+        if mean is None:
+            mean = np.mean(data)
         gamma = np.log(mean) / np.log(128)
-        return np.power(data, gamma).astype(np.uint8)
-
-    def bilateralFilter(self, data, d=9, sigmaColor=75, sigmaSpace=75):
-        return cv2.bilateralFilter(data, d, sigmaColor, sigmaSpace)
-
-    def guidedFilter(self, data, radius=5, eps=0.1):
-        meanI = cv2.boxFilter(data, -1, (radius, radius))
-        meanP = cv2.boxFilter(data, -1, (radius, radius))
-        corrI = cv2.boxFilter(data * data, -1, (radius, radius))
-        varI = corrI - meanI * meanI
-        a = varI / (varI + eps)
-        b = meanP - a * meanI
-        meanA = cv2.boxFilter(a, -1, (radius, radius))
-        meanB = cv2.boxFilter(b, -1, (radius, radius))
-        q = meanA * data + meanB
-
-    def display(self, data):
-        self.dataMax = np.max(self.data)
-        self.dataMin = np.min(self.data)
-        dataClone = copy.deepcopy(self.data)
-
-        dataClone = self.applyWindowing(dataClone)
-        dataClone = self.normalize(dataClone)
-        dataClone = self.bilateralFilter(dataClone)
-        dataClone = self.adaptiveGammaCorrection(dataClone)
-        dataClone = self.applyClahe(dataClone)
-
-        return dataClone
+        lut = np.power(np.arange(256), gamma).astype(np.uint8)
+        return cv2.LUT(data, lut, dst=out)
+
+    @timed('bilateral')
+    def bilateralFilter(self, data, d=9, sigmaColor=75, sigmaSpace=75, out=None):
+        import cv2
+        return cv2.bilateralFilter(data, d, sigmaColor, sigmaSpace, dst=out)
+
+    def guidedBuffers(self, rows, cols, scale, owned):
+        #   float32 work arrays of guidedFilter: the padded plane and one more at full size, four at
+        #   1/scale. The loader keeps one set per plane size when the caller passes out=
+        key = (rows, cols, scale)
+        if owned and key in self.guidedScratch:
+            return self.guidedScratch[key]
+        paddedRows, paddedCols = rows + -rows % scale, cols + -cols % scale
+        full = (paddedRows, paddedCols)
+        small = (paddedRows // scale, paddedCols // scale)
+        buffers = tuple(np.empty(shape, dtype=np.float32) for shape in (full, full) + (small,) * 4)
+        if owned:
+            self.guidedScratch = {key: buffers}
+        return buffers
+
+    @timed('guided')
+    def guidedFilter(self, data, radius=4, eps=0.01, scale=2, out=None):
+        #   Fast self-guided filter (He & Sun): the coefficients are fitted on a 1/scale copy with
+        #   box filters (O(1) per pixel) and upsampled, only the final blend runs at full size.
+        #   Every step writes into the work arrays, with out= the filter allocates nothing
+        import cv2
+        rows, cols = data.shape
+        image, upsampled, small, mean, work, var = self.guidedBuffers(rows, cols, scale, out is not None)
+        image[:rows, :cols] = data
+        image[:rows, :cols] *= np.float32(1 / 255)
+        #   Sides padded to a multiple of scale (as BORDER_REFLECT_101) so the coarse grid lines up
+        #   with any scale-aligned crop
+        for row in range(rows, image.shape[0]):
+            image[row, :cols] = image[2 * rows - 2 - row, :cols]
+        for col in range(cols, image.shape[1]):
+            image[:, col] = image[:, 2 * cols - 2 - col]
+        if scale > 1:
+            cv2.resize(image, (small.shape[1], small.shape[0]), dst=small, interpolation=cv2.INTER_AREA)
+        else:
+            small = image
+        size = (2 * max(1, radius // scale) + 1,) * 2
+
+        #   var = box(I * I) - mean^2, a = var / (var + eps) in var, b = mean - a * mean in work
+        cv2.boxFilter(small, -1, size, dst=mean)
+        np.multiply(small, small, out=work)
+        cv2.boxFilter(work, -1, size, dst=var)
+        np.multiply(mean, mean, out=work)
+        np.subtract(var, work, out=var)
+        np.add(var, eps, out=work)
+        np.divide(var, work, out=var)
+        np.multiply(var, mean, out=work)
+        np.subtract(mean, work, out=work)
+        #   Box-filtered a into mean, box-filtered b into var
+        cv2.boxFilter(var, -1, size, dst=mean)
+        cv2.boxFilter(work, -1, size, dst=var)
+
+        #   q = a * I + b, the upsampled b goes where I was once I is used
+        fullSize = (image.shape[1], image.shape[0])
+        if scale > 1:
+            cv2.resize(mean, fullSize, dst=upsampled, interpolation=cv2.INTER_LINEAR)
+            np.multiply(upsampled, image, out=upsampled)
+            cv2.resize(var, fullSize, dst=image, interpolation=cv2.INTER_LINEAR)
+        else:
+            np.multiply(mean, image, out=upsampled)
+            image[...] = var
+        np.add(upsampled, image, out=upsampled)
+        upsampled *= 255
+        if out is None:
+            out = np.empty(data.shape, dtype=np.uint8)
+        #   convertTo saturates and rounds to uint8
+        cv2.convertScaleAbs(upsampled[:rows, :cols], dst=out)
+        return out
+
+    def denoiseMode(self, data):
+        #   Resolves 'auto' from timings measured once per plane size
+        if self.denoise != 'auto':
+            return self.denoise
+
+        timings = self.denoiseTimings.get(data.shape)
+        if timings is None:
+            timings = {}
+            for mode in ('bilateral', 'guided'):
+                start = time.perf_counter()
+                self.applyDenoise(data, mode)
+                timings[mode] = (time.perf_counter() - start) * 1000
+            self.denoiseTimings[data.shape] = timings
+
+        for mode in ('bilateral', 'guided'):
+            if timings[mode] <= self.latencyBudget:
+                return mode
+        return 'none'
+
+    def denoiseParams(self, mode):
+        return {'bilateral': self.bilateralParams, 'guided': self.guidedParams}.get(mode, ())
+
+    def applyDenoise(self, data, mode, out=None):
+        if mode == 'bilateral':
+            return self.bilateralFilter(data, *self.bilateralParams, out=out)
+        if mode == 'guided':
+            return self.guidedFilter(data, *self.guidedParams, out=out)
+        if out is None:
+            return data
+        np.copyto(out, data)
+        return out
+
+    def newCaches(self):
+        return {name: OrderedDict() for name in self.stageCache}, OrderedDict()
+
+    def useCaches(self, caches):
+        #   Swaps in another (stageCache, tileCache) pair and returns the current one. Extra viewports
+        #   render with their own pair so their windows never evict the main viewport's entries,
+        #   callers hold self.lock until they swap back
+        previous = self.stageCache, self.tileCache
+        self.stageCache, self.tileCache = caches
+        return previous
+
+    def runStage(self, name, key, stage, *args):
+        cache = self.stageCache[name]
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        result = stage(*args)
+        cache[key] = result
+        if len(cache) > self.cacheSize:
+            cache.popitem(last=False)
+        return result
+
+    def displayBuffered(self, plane):
+        if self.floatBuffer is None or self.floatBuffer.shape != plane.shape:
+            self.floatBuffer = np.empty(plane.shape, dtype=np.float32)
+            self.byteBuffers = (np.empty(plane.shape, dtype=np.uint8),
+                                np.empty(plane.shape, dtype=np.uint8))
+
+        #   Ping-pong between the two uint8 buffers, bilateral and CLAHE can't run in place
+        a, b = self.byteBuffers
+        self.applyWindowingLut(plane, out=a)
+        self.applyDenoise(a, self.denoiseMode(a), out=b)
+        self.adaptiveGammaCorrection(b, out=a)
+        self.applyClahe(a, *self.claheParams, out=b)
+        return b
+
+    @timed('render')
+    def display(self, data, preview=False):
+        #   preview: half-size pyramid proxy with denoise and CLAHE skipped, for interactive dragging
+        with self.lock:
+            if self.dataMin is None:
+                self.updateStats()
+            if self.reuseBuffers and not preview:
+                levels = self.pyramid(self.data, self.sliceIndex)
+                return self.displayBuffered(levels[self.pyramidLevel(levels)])
+            return self.renderPlane(self.data, self.sliceIndex, preview)
+
+    def renderSlice(self, index):
+        #   Renders another slice into the stage caches without moving the current one. Nothing is
+        #   returned, the stage caches hold the result and the prefetcher keeps no second copy
+        with self.lock:
+            self.renderPlane(self.planeAt(index), index)
+
+    def renderWindow(self, wc, ww):
+        #   The current plane at another window, for presets. Runs the stages directly: going
+        #   through the stage caches would evict the current window and the prefetched slices
+        with self.lock:
+            if self.dataMin is None:
+                self.updateStats()
+            saved = self.wc, self.ww, self.firstLoadFlag, self.lut, self.lutKey
+            self.wc, self.ww, self.firstLoadFlag = wc, ww, False
+            try:
+                levels = self.pyramid(self.data, self.sliceIndex)
+                windowed = self.applyWindowingLut(levels[self.pyramidLevel(levels)])
+                denoised = self.applyDenoise(windowed, self.denoiseMode(windowed))
+                return self.applyClahe(self.adaptiveGammaCorrection(denoised), *self.claheParams)
+            finally:
+                self.wc, self.ww, self.firstLoadFlag, self.lut, self.lutKey = saved
+
+    def renderPlane(self, plane, sliceIndex, preview=False):
+        levels = self.pyramid(plane, sliceIndex)
+        level = self.pyramidLevel(levels)
+        if preview:
+            level = min(level + 1, len(levels) - 1)
+        plane = levels[level]
+
+        #   Keys grow stage by stage so changing a downstream parameter only re-runs what follows it
+        if preview:
+            key = (self.dataKey, sliceIndex, level, self.wc, self.ww, self.firstLoadFlag)
+            windowed = self.runStage('window', key, self.applyWindowingLut, plane)
+            return self.runStage('gamma', key + ('preview',), self.adaptiveGammaCorrection, windowed)
+
+        key, mode, denoised = self.denoisedPlane(plane, sliceIndex, level)
+        gamma = self.runStage('gamma', key, self.adaptiveGammaCorrection, denoised)
+        key += (self.claheParams[0], *self.claheParams[1])
+        return self.runStage('clahe', key, self.applyClahe, gamma, *self.claheParams)
+
+    def denoisedPlane(self, plane, sliceIndex, level):
+        key = (self.dataKey, sliceIndex, level, self.wc, self.ww, self.firstLoadFlag)
+        windowed = self.runStage('window', key, self.applyWindowingLut, plane)
+        mode = self.denoiseMode(windowed)
+        key += (mode, *self.denoiseParams(mode))
+        return key, mode, self.runStage('denoise', key, self.applyDenoise, windowed, mode)
+
+    @timed('tiles')
+    def renderTiles(self, zoom, region):
+        #   region: visible (x0, y0, x1, y1) as fractions of the plane. Returns the shape of the level
+        #   matching targetSize * zoom and its tiles that intersect the region as (x, y, pixels)
+        with self.lock:
+            if self.dataMin is None:
+                self.updateStats()
+            levels = self.pyramid(self.data, self.sliceIndex)
+            fit = self.pyramidLevel(levels)
+            level = self.pyramidLevel(levels, (self.targetSize or 0) * zoom)
+            plane = levels[level]
+            rows, cols = plane.shape
+
+            #   Denoise mode and gamma curve come from the plane shown at zoom 1, so zooming
+            #   never changes brightness
+            fitKey, mode, fitDenoised = self.denoisedPlane(levels[fit], self.sliceIndex, fit)
+            key = fitKey[:2] + (level, fit) + fitKey[3:] + (self.claheParams[0], *self.claheParams[1])
+
+            size = self.tileSize
+            x0, y0, x1, y1 = region
+            columns = range(max(0, int(x0 * cols) // size), min(cols, int(np.ceil(x1 * cols))) // size + 1)
+            tileRows = range(max(0, int(y0 * rows) // size), min(rows, int(np.ceil(y1 * rows))) // size + 1)
+            wanted = [(tx * size, ty * size) for ty in tileRows for tx in columns
+                      if tx * size < cols and ty * size < rows]
+
+            missing = [origin for origin in wanted if key + origin not in self.tileCache]
+            if missing:
+                mean = np.mean(fitDenoised)
+                left, top = min(x for x, _ in missing), min(y for _, y in missing)
+                right = min(cols, max(x for x, _ in missing) + size)
+                bottom = min(rows, max(y for _, y in missing) + size)
+                rendered = self.renderRegion(plane, key, mode, mean, left, top, right, bottom)
+                for x, y in missing:
+                    tile = rendered[y - top:min(y + size, rows) - top, x - left:min(x + size, cols) - left]
+                    self.tileCache[key + (x, y)] = np.ascontiguousarray(tile)
+                while len(self.tileCache) > self.tileCacheSize:
+                    self.tileCache.popitem(last=False)
+
+            tiles = []
+            for x, y in wanted:
+                self.tileCache.move_to_end(key + (x, y))
+                tiles.append((x, y, self.tileCache[key + (x, y)]))
+            return plane.shape, tiles
+
+    def renderRegion(self, plane, key, mode, mean, left, top, right, bottom, margin=16):
+        #   Full pipeline on plane[top:bottom, left:right]. CLAHE runs on a crop aligned to its own
+        #   tile grid with one grid cell of context, and is padded the way OpenCV pads the whole plane,
+        #   so the region matches a full render. Denoise gets a further margin of context
+        import cv2
+        rows, cols = plane.shape
+        gridX, gridY = self.claheParams[1]
+        if rows % gridY == 0 and cols % gridX == 0:
+            paddedRows, paddedCols = rows, cols
+        else:
+            paddedRows, paddedCols = rows + gridY - rows % gridY, cols + gridX - cols % gridX
+        cellRows, cellCols = paddedRows // gridY, paddedCols // gridX
+
+        cellTop, cellLeft = max(0, top // cellRows - 1), max(0, left // cellCols - 1)
+        cellBottom = min(gridY, -(-bottom // cellRows) + 1)
+        cellRight = min(gridX, -(-right // cellCols) + 1)
+        claheTop, claheLeft = cellTop * cellRows, cellLeft * cellCols
+        claheBottom, claheRight = min(rows, cellBottom * cellRows), min(cols, cellRight * cellCols)
+
+        #   Offsets on the guided filter's coarse grid keep it aligned with the whole plane
+        step = self.guidedParams[2]
+        cropTop, cropLeft = max(0, claheTop - margin), max(0, claheLeft - margin)
+        cropTop, cropLeft = cropTop - cropTop % step, cropLeft - cropLeft % step
+        cropBottom, cropRight = min(rows, claheBottom + margin), min(cols, claheRight + margin)
+        crop = plane[cropTop:cropBottom, cropLeft:cropRight]
+
+        pointwise = plane.dtype.kind in 'iu' and (plane.dtype.itemsize <= 2 or
+                                                  int(self.dataMax) - int(self.dataMin) < (1 << 16))
+        if pointwise:
+            windowed = self.applyWindowingLut(crop)
+        else:
+            #   Float normalisation depends on the whole plane, window it once and crop
+            windowed = self.runStage('window', key[:3] + key[4:7], self.applyWindowingLut, plane)
+            windowed = windowed[cropTop:cropBottom, cropLeft:cropRight]
+        denoised = self.applyDenoise(np.ascontiguousarray(windowed), mode)
+        inner = denoised[claheTop - cropTop:claheBottom - cropTop, claheLeft - cropLeft:claheRight - cropLeft]
+        gamma = self.adaptiveGammaCorrection(np.ascontiguousarray(inner), mean=mean)
+
+        extraRows = (cellBottom - cellTop) * cellRows - gamma.shape[0]
+        extraCols = (cellRight - cellLeft) * cellCols - gamma.shape[1]
+        if extraRows or extraCols:
+            gamma = cv2.copyMakeBorder(gamma, 0, extraRows, 0, extraCols, cv2.BORDER_REFLECT_101)
+        clahe = self.applyClahe(gamma, self.claheParams[0], (cellRight - cellLeft, cellBottom - cellTop))
+        return clahe[top - claheTop:bottom - claheTop, left - claheLeft:right - claheLeft]
 
     def setWC(self, to: int):
         self.wc = to
@@ -89,5 +744,171 @@ class DicomLoader:
         self.ww = to
         return self.data
 
-#   TODO: nifti doesn't work, it's shit
+#   NIfTI volumes through nibabel's array proxy: only the displayed slice is ever read
+
+class NiftiLoader(DicomLoader):
+    def __init__(self, cacheSize=8, sliceCacheSize=16, **kwargs):
+        super().__init__(cacheSize, **kwargs)
+        self.image = None
+        self.proxy = None
+        self.depth = 1
+        self.sliceCacheSize = sliceCacheSize
+        self.sliceCache = OrderedDict()
+
+    def ni2num(self, filePath):
+        #   Uncompressed files are memory-mapped, .nii.gz slices are decoded on demand and cached
+        import nibabel as nib
+        self.filePath = filePath
+        compressed = filePath.lower().endswith('.gz')
+        self.image = nib.load(filePath, mmap=False if compressed else 'r')
+        self.proxy = self.image.dataobj
+        self.depth = self.proxy.shape[2] if len(self.proxy.shape) > 2 else 1
+        self.sliceCache.clear()
+
+        #   The range starts from the header (or the first slice) and grows as slices are visited
+        calMin, calMax = float(self.image.header['cal_min']), float(self.image.header['cal_max'])
+        self.sliceIndex = self.depth // 2
+        self.data = self.readSlice(self.sliceIndex)
+        if calMax > calMin:
+            #   Integer data keeps integer bounds, the LUT path indexes with data - dataMin
+            if self.data.dtype.kind in 'iu':
+                calMin, calMax = math.floor(calMin), math.ceil(calMax)
+            self.dataMin, self.dataMax = min(calMin, self.dataMin), max(calMax, self.dataMax)
+        #   Whole numbers like the DICOM tags and the presets, the WC/WW fields parse them with int()
+        self.wc = round((self.dataMax + self.dataMin) / 2)
+        self.ww = max(1, round(self.dataMax - self.dataMin))
+        self.invalidate()
+        return self.data, self.image, self.wc, self.ww
+
+    @timed('decode.slice')
+    def readSlice(self, index):
+        if index in self.sliceCache:
+            self.sliceCache.move_to_end(index)
+            return self.sliceCache[index]
+
+        if len(self.proxy.shape) > 2:
+            plane = self.proxy[:, :, index] if len(self.proxy.shape) == 3 else self.proxy[:, :, index, 0]
+        else:
+            plane = self.proxy[:, :]
+        #   NIfTI is (x, y), the display wants rows first
+        plane = np.asanyarray(plane)
+        if self.dtypePolicy == 'compact' and plane.dtype == np.float64:
+            plane = plane.astype(np.float32)
+        plane = np.ascontiguousarray(plane.T)
+
+        #   Windowing and the LUT need a range that covers every slice shown so far
+        planeMin, planeMax = plane.min().item(), plane.max().item()
+        if self.dataMin is None or planeMin < self.dataMin or planeMax > self.dataMax:
+            self.dataMin = planeMin if self.dataMin is None else min(self.dataMin, planeMin)
+            self.dataMax = planeMax if self.dataMax is None else max(self.dataMax, planeMax)
+            self.invalidate()
+
+        self.sliceCache[index] = plane
+        if len(self.sliceCache) > self.sliceCacheSize:
+            self.sliceCache.popitem(last=False)
+        return plane
+
+    @property
+    def sliceCount(self):
+        return self.depth
+
+    def setSlice(self, index):
+        with self.lock:
+            self.sliceIndex = max(0, min(index, self.depth - 1))
+            self.data = self.readSlice(self.sliceIndex)
+            return self.data
+
+    def planeAt(self, index):
+        return self.readSlice(index)
+
+#   Background prefetch of the neighbours of the current file or slice
+
+class Prefetcher:
+    def __init__(self, load, lookAhead=2, lookBehind=1, maxWorkers=2, maxBytes=256 << 20):
+        #   load(item) runs on the pool, its results are kept until taken, until the item leaves
+        #   the window or until they push the total over maxBytes (oldest first). A load that only
+        #   warms another cache returns None, such items are loaded again when they re-enter the window
+        self.load = load
+        self.lookAhead = lookAhead
+        self.lookBehind = lookBehind
+        self.maxBytes = maxBytes
+        self.pool = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.lock = threading.Lock()
+        self.items = []
+        self.wanted = set()
+        self.futures = {}
+        self.ready = OrderedDict()
+        self.readyBytes = 0
+
+    def setItems(self, items):
+        self.clear()
+        self.items = list(items)
+
+    def moveTo(self, index):
+        #   Nearest neighbours first, look-ahead before look-behind
+        order = []
+        for step in range(1, max(self.lookAhead, self.lookBehind) + 1):
+            if step <= self.lookAhead and index + step < len(self.items):
+                order.append(self.items[index + step])
+            if step <= self.lookBehind and index - step >= 0:
+                order.append(self.items[index - step])
+
+        with self.lock:
+            #   Anything outside the new window is cancelled (or dropped when it finishes)
+            self.wanted = set(order)
+            for item in [item for item in self.futures if item not in self.wanted]:
+                self.futures.pop(item).cancel()
+            for item in [item for item in self.ready if item not in self.wanted]:
+                self.readyBytes -= getattr(self.ready.pop(item), 'nbytes', 0)
+            for item in order:
+                if item not in self.ready and item not in self.futures:
+                    self.futures[item] = self.pool.submit(self.run, item)
+
+    def run(self, item):
+        try:
+            result = self.load(item)
+        finally:
+            with self.lock:
+                self.futures.pop(item, None)
+
+        with self.lock:
+            if item not in self.wanted or result is None:
+                return
+            previous = self.ready.pop(item, None)
+            if previous is not None:
+                self.readyBytes -= getattr(previous, 'nbytes', 0)
+            self.ready[item] = result
+            self.readyBytes += getattr(result, 'nbytes', 0)
+            while self.readyBytes > self.maxBytes and len(self.ready) > 1:
+                _, evicted = self.ready.popitem(last=False)
+                self.readyBytes -= getattr(evicted, 'nbytes', 0)
+
+    def get(self, item):
+        #   Waits for an item that is already in flight instead of loading it twice
+        with self.lock:
+            future = self.futures.get(item)
+        if future is not None:
+            try:
+                future.result()
+            except Exception:
+                return None
+
+        with self.lock:
+            result = self.ready.pop(item, None)
+            if result is not None:
+                self.readyBytes -= getattr(result, 'nbytes', 0)
+            return result
+
+    def clear(self):
+        with self.lock:
+            self.wanted = set()
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+            self.ready.clear()
+            self.readyBytes = 0
+
+    def close(self):
+        self.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
 
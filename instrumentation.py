@@ -0,0 +1,69 @@
+# Span timings for the display pipeline, painting and exports
+
+import json
+import time
+import threading
+import numpy as np
+from collections import deque
+from functools import wraps
+
+class Registry:
+
+    #   Rolling window of the last windowSize durations (ms) per span name. Disabled, a timed
+    #   function costs one attribute check
+
+    def __init__(self, windowSize=256):
+        self.enabled = False
+        self.windowSize = windowSize
+        self.samples = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def timed(self, name):
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(name, (time.perf_counter() - start) * 1000)
+            return wrapper
+        return decorate
+
+    def record(self, name, ms):
+        with self.lock:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.windowSize)
+                self.counts[name] = 0
+            self.samples[name].append(ms)
+            self.counts[name] += 1
+
+    def stats(self):
+        with self.lock:
+            samples = {name: list(values) for name, values in self.samples.items()}
+            counts = dict(self.counts)
+        stats = {}
+        for name, values in sorted(samples.items()):
+            p50, p95 = np.percentile(values, (50, 95))
+            stats[name] = {'count': counts[name], 'last': values[-1], 'p50': float(p50), 'p95': float(p95)}
+        return stats
+
+    def summary(self, limit=6):
+        #   One line for the status bar, the spans with the highest p95 first
+        stats = sorted(self.stats().items(), key=lambda item: -item[1]['p95'])[:limit]
+        return '  '.join(f'{name} {values["p50"]:.1f}/{values["p95"]:.1f} ms' for name, values in stats)
+
+    def dump(self, path):
+        with open(path, 'w') as file:
+            json.dump({'windowSize': self.windowSize, 'spans': self.stats()}, file, indent=4)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.counts.clear()
+
+registry = Registry()
+timed = registry.timed
@@ -0,0 +1,208 @@
+# Window/level rendering off the GUI thread
+
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from instrumentation import timed
+from PyQt6.QtCore import QObject, Qt, pyqtSignal
+from PyQt6.QtGui import QImage
+
+@timed('scale')
+def toQImage(array, height):
+    #   Wraps a uint8 display array as a grayscale QImage (no copy) and scales it once to the
+    #   square image label. The result always owns its pixels: at the label size already,
+    #   scaled() would return a shallow copy that still points into the array
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    rows, cols = array.shape
+    image = QImage(array.data, cols, rows, array.strides[0], QImage.Format.Format_Grayscale8)
+    if (rows, cols) == (height, height):
+        return image.copy()
+    return image.scaled(height, height, Qt.AspectRatioMode.IgnoreAspectRatio,
+                        Qt.TransformationMode.SmoothTransformation)
+
+class RenderScheduler(QObject):
+
+    rendered = pyqtSignal(QImage, object)
+    tilesRendered = pyqtSignal(object, object)
+    failed = pyqtSignal(str, object)
+
+    def __init__(self, parent=None, setsWindow=True, cacheSize=16):
+        #   setsWindow: the loader keeps the rendered window (main viewport), other viewports render
+        #   their own window and put the loader's back. Full-quality images are kept per scheduler,
+        #   and other viewports also get their own stage and tile caches (loaderCaches)
+        super().__init__(parent)
+        self.condition = threading.Condition()
+        self.pending = None
+        self.running = True
+        self.setsWindow = setsWindow
+        self.cacheSize = cacheSize
+        self.images = OrderedDict()
+        self.loaderCaches = None
+
+        self.requested = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def request(self, loader, wc, ww, height, preview=False, viewport=None):
+        #   Only the latest request is kept, an unstarted one it replaces counts as coalesced.
+        #   viewport: (zoom, region) of a zoomed view, its tiles follow the full-quality image.
+        #   plane: (dataKey, sliceIndex) the request is for, a result for another slice is dropped
+        plane = (loader.dataKey, loader.sliceIndex)
+        with self.condition:
+            self.requested += 1
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = (loader, wc, ww, height, preview, viewport, plane)
+            self.condition.notify()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while self.pending is None and self.running:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                request, self.pending = self.pending, None
+
+            #   A failed render is reported and the thread keeps serving later requests
+            try:
+                image, tiles = self.render(*request)
+            except Exception as error:
+                with self.condition:
+                    self.errors += 1
+                self.failed.emit(f'{type(error).__name__}: {error}', request)
+                continue
+
+            with self.condition:
+                #   A newer request arrived while rendering or the slice moved on, the result is stale
+                if self.pending is not None or image is None:
+                    self.coalesced += 1
+                    continue
+                self.completed += 1
+            self.rendered.emit(image, request)
+            if tiles is not None:
+                self.tilesRendered.emit(tiles, request)
+
+    def render(self, loader, wc, ww, height, preview, viewport, plane):
+        tiles = None
+        with loader.lock:
+            if (loader.dataKey, loader.sliceIndex) != plane:
+                return None, None
+            key = PresetCache.key(loader, wc, ww, height) + (preview,)
+            saved = loader.wc, loader.ww, loader.firstLoadFlag
+            if not self.setsWindow:
+                caches = self.loaderCaches
+                if caches is None or caches[0] != loader.token:
+                    caches = self.loaderCaches = (loader.token, loader.newCaches())
+                mainCaches = loader.useCaches(caches[1])
+            loader.wc = wc
+            loader.ww = ww
+            loader.firstLoadFlag = False
+            try:
+                with self.condition:
+                    image = self.images.get(key)
+                    if image is not None:
+                        self.images.move_to_end(key)
+                if image is None:
+                    image = toQImage(loader.display(loader.data, preview=preview), height)
+                    with self.condition:
+                        self.images[key] = image
+                        while len(self.images) > self.cacheSize:
+                            self.images.popitem(last=False)
+                if viewport is not None and not preview:
+                    tiles = loader.renderTiles(*viewport)
+            except Exception:
+                #   Even the main viewport keeps the last window that rendered
+                loader.wc, loader.ww, loader.firstLoadFlag = saved
+                raise
+            finally:
+                if not self.setsWindow:
+                    loader.wc, loader.ww, loader.firstLoadFlag = saved
+                    loader.useCaches(mainCaches)
+        return image, tiles
+
+    def clearCache(self):
+        with self.condition:
+            self.images.clear()
+            self.loaderCaches = None
+
+    def counters(self):
+        with self.condition:
+            return {'requested': self.requested, 'coalesced': self.coalesced, 'completed': self.completed,
+                    'errors': self.errors}
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(timeout=1)
+
+class PresetCache:
+
+    #   Display-ready images of the windowing presets, rendered in the background after an image loads
+
+    def __init__(self, maxImages=32):
+        self.maxImages = maxImages
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(loader, wc, ww, height):
+        return (loader.token, loader.dataKey, loader.sliceIndex, loader.denoise, height, wc, ww)
+
+    def prerender(self, loader, presets, height):
+        self.clear()
+        self.job = self.pool.submit(self.work, loader, presets, height, self.generation)
+
+    def work(self, loader, presets, height, generation):
+        for preset in presets:
+            with loader.lock:
+                if generation != self.generation:
+                    return
+                key = self.key(loader, preset['wc'], preset['ww'], height)
+                #   Outside the loader's stage caches, which keep serving the current window
+                image = toQImage(loader.renderWindow(preset['wc'], preset['ww']), height)
+
+            with self.lock:
+                if generation != self.generation:
+                    return
+                self.images[key] = image
+                while len(self.images) > self.maxImages:
+                    self.images.popitem(last=False)
+
+    def get(self, loader, wc, ww, height):
+        with self.lock:
+            image = self.images.get(self.key(loader, wc, ww, height))
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return image
+
+    def clear(self):
+        #   Bumping the generation drops whatever a running job still produces for the old image
+        with self.lock:
+            self.generation += 1
+            self.images.clear()
+        if self.job is not None:
+            self.job.cancel()
+            self.job = None
+
+    def counters(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'images': len(self.images)}
+
+    def close(self):
+        self.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -3,11 +3,10 @@
 import os
 import math
 import numpy as np
-import pandas as pd
-import nibabel.nifti1 as nib
-from PyQt6.QtGui import QImage
-from matplotlib.path import Path
-from skimage.transform import resize
+from instrumentation import timed
+
+#   pandas, nibabel, matplotlib and scikit-image are only needed for exports and are imported there,
+#   batch_export.py uses this module without PyQt6
 
 class DicomSaver:
 
@@ -16,199 +15,170 @@ class DicomSaver:
         self.actImgW = None
         self.tr = None
 
-    def rect2npy(self, path: str, arr: np.ndarray, annotations: list) -> None:
+    def rectBoxes(self, store):
+        #   (label, x1, y1, x2, y2) in raw pixels for every rectangle of the store
+        for shape in store.ofKind('rectangle'):
+            x1, y1, x2, y2 = [math.floor(i * self.tr) for i in shape.bbox]
+            yield shape.label, x1, y1, x2, y2
+
+    def polygonVerts(self, shape):
+        return [(int(x * self.tr), int(y * self.tr)) for x, y in shape.points.tolist()]
+
+    def polygonMasks(self, store, shape):
+        #   One mask per label, the union of its polygons. Containment is only tested inside each
+        #   polygon's bounding box instead of over the whole image
+        from matplotlib.path import Path
+        masks = {}
+        rows, cols = shape
+        for polygon in store.ofKind('polygon'):
+            verts = np.array(self.polygonVerts(polygon))
+            if len(verts) < 3:
+                continue
+            mask = masks.setdefault(polygon.label, np.zeros(shape, dtype=bool))
+            x1, y1 = np.maximum(verts.min(axis=0), 0)
+            x2, y2 = np.minimum(verts.max(axis=0), (cols - 1, rows - 1))
+            if x1 > x2 or y1 > y2:
+                continue
+            xx, yy = np.meshgrid(np.arange(x1, x2 + 1), np.arange(y1, y2 + 1))
+            inside = Path(verts).contains_points(np.column_stack((xx.ravel(), yy.ravel())))
+            mask[y1:y2+1, x1:x2+1] |= inside.reshape(xx.shape)
+        return masks
+
+    def labelMasks(self, store, arr, kinds):
+        #   label -> mask of its shapes of the given kinds: arr's dtype when the label has a rectangle,
+        #   bool for polygons only. A label with both gets one mask, the union
+        masks = {}
+        if 'rectangle' in kinds:
+            for maskName, x1, y1, x2, y2 in self.rectBoxes(store):
+                mask = masks.setdefault(maskName, np.zeros_like(arr))
+                mask[max(y1, 0):y2+1, max(x1, 0):x2+1] = 1
+        if 'polygon' in kinds:
+            for maskName, mask in self.polygonMasks(store, arr.shape[:2]).items():
+                if maskName in masks:
+                    masks[maskName][mask] = 1
+                else:
+                    masks[maskName] = mask
+        return masks
+
+    def csvRows(self, store, imgpath, kinds):
+        rows = []
+        for shape in store:
+            if shape.kind not in kinds:
+                continue
+            if shape.kind == 'rectangle':
+                x1, y1, x2, y2 = [math.floor(i * self.tr) for i in shape.bbox]
+                values = (x1, y1, x2, y1, x1, y2, x2, y2)
+            else:
+                values = self.polygonVerts(shape)
+            rows.append({
+                'image path': imgpath,
+                shape.label: values
+            })
+        return rows
+
+    def jsonRows(self, store, imgpath, kinds):
+        #   COCO style, rectangles as their four corners
+        rows = []
+        for shape in store:
+            if shape.kind not in kinds:
+                continue
+            if shape.kind == 'rectangle':
+                x1, y1, x2, y2 = [math.floor(i * self.tr) for i in shape.bbox]
+                segmentation = [x1, y1, x2, y1, x2, y2, x1, y2]
+            else:
+                verts = self.polygonVerts(shape)
+                x1, y1 = np.min(verts, axis=0).tolist()
+                x2, y2 = np.max(verts, axis=0).tolist()
+                segmentation = [coord for vert in verts for coord in vert]
+            W = x2 - x1
+            H = y2 - y1
+            rows.append({
+                'image path': imgpath,
+                'label': shape.label,
+                'bbox': [x1, y1, W, H],
+                'area': W * H,
+                'segmentation': segmentation,
+                'width': W,
+                'height': H,
+            })
+        return rows
 
-        for annotation in annotations:
-            maskName = annotation['label']
-            maskPath = path + '_' + maskName + '_mask' 
-            bbox = annotation['bbox']
-            newBbox = [math.floor(i * self.tr) for i in bbox]
-            x1, y1, x2, y2 = newBbox
-            if x1 > x2:
-                x1, x2 = x2, x1
-            if y1 > y2:
-                y1, y2 = y2, y1
-            mask = np.zeros_like(arr)
-            for i in range(len(mask)):
-                for j in range(len(mask[i])):
-                    if y1 <= i <= y2:
-                        if x1 <= j <= x2:
-                            mask[i][j] = 1
-            np.save(maskPath, mask)
+    def saveNpy(self, path, masks):
+        for maskName, mask in masks.items():
+            np.save(path + '_' + maskName + '_mask', mask)
 
-        # mainPath = path + '_main'
-        # np.save(mainPath, arr)
+    def saveNii(self, path, masks):
+        import nibabel.nifti1 as nib
+        for maskName, mask in masks.items():
+            niimg = nib.Nifti1Image(mask.astype(np.uint8) if mask.dtype == bool else mask, np.eye(4))
+            nib.save(niimg, path + '_' + maskName + '_mask.nii.gz')
 
+    def saveCsv(self, path, rows):
+        import pandas as pd
+        pd.DataFrame(rows).to_csv(path + '_masks.csv')
 
-    def rect2csv(self, path: str, arr: np.ndarray, annotations: list, imgpath: str) -> None:
-        mainPath = path + '_main'
-        print('main: ', mainPath)
-        df = pd.DataFrame()
+    def saveJson(self, path, rows):
+        import pandas as pd
+        pd.DataFrame(rows).to_json(path + '_masks.json', orient='records', indent=4)
 
-        for annotation in annotations:
-            maskName = annotation['label']
-            maskPath = path + '_' + maskName + '_mask' 
-            bbox = annotation['bbox']
-            newBbox = [math.floor(i * self.tr) for i in bbox]
-            print(newBbox)
-            x1, y1, x2, y2 = newBbox
-            if x1 > x2:
-                x1, x2 = x2, x1
-            if y1 > y2:
-                y1, y2 = y2, y1
-            values = (x1, y1, x2, y1, x1, y2, x2, y2)
-            newRow = {
-                'image path': imgpath,
-                maskName: values  
-            }
-            
-            df = pd.concat([df, pd.DataFrame([newRow])], ignore_index=True)
-        
-        csvPath = path + '_masks.csv'
-        df.to_csv(csvPath)
-        # mainPath = path + '_main'
-        # np.save(mainPath, arr)
 
+    @timed('export.rect2npy')
+    def rect2npy(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNpy(path, self.labelMasks(store, arr, ('rectangle',)))
 
-    def rect2json(self, path: str, arr: np.ndarray, annotations: list, imgpath: str) -> None:
-        df = pd.DataFrame()
+    @timed('export.rect2csv')
+    def rect2csv(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveCsv(path, self.csvRows(store, imgpath, ('rectangle',)))
 
-        for annotation in annotations:
-            maskName = annotation['label']
-            bbox = annotation['bbox']
-            newBbox = [math.floor(i * self.tr) for i in bbox]
-            x1, y1, x2, y2 = newBbox
-            if x1 > x2:
-                x1, x2 = x2, x1
-            if y1 > y2:
-                y1, y2 = y2, y1
+    @timed('export.rect2json')
+    def rect2json(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveJson(path, self.jsonRows(store, imgpath, ('rectangle',)))
 
-            bboxVals = [x1, y1, x2 - x1, y2 - y1]
-            segmentation = [x1, y1, x2, y1, x2, y2, x1, y2]
-            W = x2 - x1
-            H = y2 - y1
-            area = W * H 
+    @timed('export.rect2nii')
+    def rect2nii(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNii(path, self.labelMasks(store, arr, ('rectangle',)))
 
-            newRow = {
-                'image path': imgpath,
-                'label': maskName,
-                'bbox': bboxVals,
-                'area': area,
-                'segmentation': segmentation,
-                'width': W,
-                'height': H,
-            }
-            
-            df = pd.concat([df, pd.DataFrame([newRow])], ignore_index=True)
-        
-        jsonPath = path + '_masks.json'
-        df.to_json(jsonPath, orient='records', indent=4)
+    @timed('export.poly2npy')
+    def poly2npy(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNpy(path, self.labelMasks(store, arr, ('polygon',)))
 
+    @timed('export.poly2csv')
+    def poly2csv(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveCsv(path, self.csvRows(store, imgpath, ('polygon',)))
 
-    def rect2nii(self, path: str, arr: np.ndarray, annotations: list) -> None:
-        for annotation in annotations:
-            maskName = annotation['label']
-            maskPath = path + '_' + maskName + '_mask.nii.gz'
-            bbox = annotation['bbox']
-            newBbox = [math.floor(i * self.tr) for i in bbox]
-            x1, y1, x2, y2 = newBbox
-            if x1 > x2:
-                x1, x2 = x2, x1
-            if y1 > y2:
-                y1, y2 = y2, y1
-            mask = np.zeros_like(arr)
-            mask[y1:y2+1, x1:x2+1] = 1
-            niimg = nib.Nifti1Image(mask, np.eye(4))
-            nib.save(niimg, maskPath)
-
-
-    def poly2npy(self, path: str, arr: np.ndarray, ppoints: list, pname: str) -> None:
-
-        verts: list[tuple] = []
-        codes: list = [Path.MOVETO]
-        for point in ppoints:
-            x = point.x()
-            y = point.y()
-            x = int(x * self.tr)
-            y = int(y * self.tr)
-            verts.append((x, y))
-            codes.append(Path.LINETO)
-        codes.pop()
-        codes.pop()
-        codes.append(Path.CLOSEPOLY)
-        poly = Path(verts, codes)
-        n = self.actImgW
-        x = np.arange(self.actImgW)
-        y = np.arange(self.actImgW)
-        xx, yy= np.meshgrid(x, y)
-        points = np.vstack((xx.ravel(), yy.ravel())).T
-        mask = poly.contains_points(points)
-        mask = mask.reshape(self.actImgW, self.actImgW)
-        maskName = pname
-        maskPath = path + '_' + maskName + '_mask' 
-        np.save(maskPath, mask)
-        # mainPath = path + '_main'
-        # np.save(mainPath, arr)
+    @timed('export.poly2json')
+    def poly2json(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveJson(path, self.jsonRows(store, imgpath, ('polygon',)))
 
+    @timed('export.poly2nii')
+    def poly2nii(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNii(path, self.labelMasks(store, arr, ('polygon',)))
 
-    def poly2csv(self, path: str, arr: np.ndarray, ppoints: list, pname: str, imgpath: str) -> None:
-        mainPath = path + '_main'
-        print('main: ', mainPath)
-        df = pd.DataFrame()
-
-        verts: list[tuple] = []
-        for point in ppoints:
-            x = point.x()
-            y = point.y()
-            x = int(x * self.tr)
-            y = int(y * self.tr)
-            verts.append((x, y))
-            print('points x:', x, end = ', ')
-            print('points y:', y)
-
-        newRow = {
-            'image path': imgpath,
-            pname: verts
-        }
-        df = pd.concat([df, pd.DataFrame([newRow])], ignore_index=True)
-        
-        csvPath = path + '_masks.csv'
-        df.to_csv(csvPath)
-        # mainPath = path + '_main'
-        # np.save(mainPath, arr)
+    #   Rectangles and polygons together, one file per label (npy, nii) or one table (csv, json)
+
+    @timed('export.shapes2npy')
+    def shapes2npy(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNpy(path, self.labelMasks(store, arr, ('rectangle', 'polygon')))
+
+    @timed('export.shapes2csv')
+    def shapes2csv(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveCsv(path, self.csvRows(store, imgpath, ('rectangle', 'polygon')))
 
+    @timed('export.shapes2json')
+    def shapes2json(self, path: str, arr: np.ndarray, store, imgpath: str) -> None:
+        self.saveJson(path, self.jsonRows(store, imgpath, ('rectangle', 'polygon')))
 
-    def poly2nii(self, path: str, arr: np.ndarray, ppoints: list, pname: str) -> None:
-        verts: list[tuple] = []
-        codes: list = [Path.MOVETO]
-        for point in ppoints:
-            x = int(point.x() * self.tr)
-            y = int(point.y() * self.tr)
-            verts.append((x, y))
-            codes.append(Path.LINETO)
-        codes.pop()
-        codes.append(Path.CLOSEPOLY)
-        poly = Path(verts, codes)
-        x, y = np.meshgrid(np.arange(self.actImgW), np.arange(self.actImgW))
-        points = np.vstack((x.ravel(), y.ravel())).T
-        mask = poly.contains_points(points).reshape(self.actImgW, self.actImgW)
-        maskPath = path + '_' + pname + '_mask.nii.gz'
-        nii_img = nib.Nifti1Image(mask, np.eye(4))
-        nib.save(nii_img, maskPath)
+    @timed('export.shapes2nii')
+    def shapes2nii(self, path: str, arr: np.ndarray, store) -> None:
+        self.saveNii(path, self.labelMasks(store, arr, ('rectangle', 'polygon')))
 
 
+    @timed('export.paint2npy')
     def paint2npy(self, path: str, arr: np.ndarray, paintLayers: list):
+        from skimage.transform import resize
         for layer in paintLayers:
-            qImg = layer.pixmap.toImage()
-            W = qImg.width()
-            H = qImg.height()
-            qImg = qImg.convertToFormat(QImage.Format.Format_RGBA8888)
-            ptr = qImg.bits()
-            ptr.setsize(W * H * 4)
-            arr = np.array(ptr).reshape(W, H, 4)
-
-            mask = arr[:, :, 3] > 0  # Alpha channel is the 4th channel (index 3)
-            print(arr.shape)
+            mask = self.layerMask(layer)
+            W, H = mask.shape
 
             newW = int(W * self.tr)
             newH = int(H * self.tr)
@@ -224,53 +194,13 @@ class DicomSaver:
         # np.save(mainPath, arr)
 
 
-    def poly2json(self, path: str, arr: np.ndarray, ppoints: list, pname: str, imgpath: str) -> None:
-        df = pd.DataFrame()
-
-        verts: list[tuple] = []
-        xMin, yMin, xMax, yMax = float('inf'), float('inf'), -float('inf'), -float('inf')
-
-        for point in ppoints:
-            x = point.x()
-            y = point.y()
-            x = int(x * self.tr)
-            y = int(y * self.tr)
-            verts.append((x, y))
-
-            xMin, yMin = min(xMin, x), min(yMin, y)
-            xMax, yMax = max(xMax, x), max(yMax, y)
-
-        bboxVals = [xMin, yMin, xMax - xMin, yMax - yMin]
-        W = xMax - xMin
-        H = yMax - yMin
-        area = W * H
-        segmentation = [coord for vert in verts for coord in vert]
-
-        newRow = {
-            'image path': imgpath,
-            'label': pname,
-            'bbox': bboxVals,
-            'area': area,
-            'segmentation': segmentation,
-            'width': W,
-            'height':H, 
-        }
-        
-        df = pd.concat([df, pd.DataFrame([newRow])], ignore_index=True)
-        
-        jsonPath = path + '_masks.json'
-        df.to_json(jsonPath, orient='records', indent=4)
-
-
+    @timed('export.paint2nii')
     def paint2nii(self, path: str, arr: np.ndarray, paintLayers: list):
+        import nibabel.nifti1 as nib
+        from skimage.transform import resize
         for layer in paintLayers:
-            qImg = layer.pixmap.toImage()
-            W, H = qImg.width(), qImg.height()
-            qImg = qImg.convertToFormat(QImage.Format.Format_RGBA8888)
-            ptr = qImg.bits()
-            ptr.setsize(W * H * 4)
-            arr = np.array(ptr).reshape(W, H, 4)
-            mask = arr[:, :, 3] > 0
+            mask = self.layerMask(layer)
+            W, H = mask.shape
             newW, newH = int(W * self.tr), int(H * self.tr)
             scaledMask = resize(mask, (newW, newH), anti_aliasing=False, preserve_range=True)
             scaledMask = scaledMask > 0.5
@@ -280,6 +210,13 @@ class DicomSaver:
             nib.save(nii_img, maskPath)
 
 
+    def layerMask(self, layer):
+        #   Painted pixels of a layer: its allocated tiles, or a display-size mask given directly
+        mask = getattr(layer, 'mask', None)
+        if mask is not None:
+            return np.asarray(mask) > 0
+        return layer.toMask()
+
     def updateTr(self):
         if self.dspImgW is not None and self.actImgW:
             self.tr = self.actImgW / self.dspImgW 
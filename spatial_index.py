@@ -0,0 +1,89 @@
+#   Uniform grid over annotation bounding boxes for hit-testing in base (display) coordinates
+
+class GridIndex:
+
+    #   Every box is listed in each cellSize x cellSize cell it overlaps, a point query only looks
+    #   at the boxes of one cell. Ids are increasing ints, a later id is drawn on top
+
+    def __init__(self, cellSize=32):
+        self.cellSize = cellSize
+        self.cells = {}
+        self.boxes = {}
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, id):
+        return id in self.boxes
+
+    @staticmethod
+    def normalize(bbox):
+        x1, y1, x2, y2 = bbox
+        return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+    def cellRange(self, box):
+        x1, y1, x2, y2 = box
+        size = self.cellSize
+        for cx in range(int(x1) // size, int(x2) // size + 1):
+            for cy in range(int(y1) // size, int(y2) // size + 1):
+                yield cx, cy
+
+    def insert(self, id, bbox):
+        if id in self.boxes:
+            self.remove(id)
+        box = self.normalize(bbox)
+        self.boxes[id] = box
+        for cell in self.cellRange(box):
+            self.cells.setdefault(cell, set()).add(id)
+
+    def update(self, id, bbox):
+        #   Only the cells the box leaves or enters are touched, a small drag usually changes none
+        box = self.normalize(bbox)
+        old = self.boxes.get(id)
+        if old is None:
+            self.insert(id, box)
+            return
+        self.boxes[id] = box
+        oldCells, newCells = set(self.cellRange(old)), set(self.cellRange(box))
+        for cell in oldCells - newCells:
+            ids = self.cells[cell]
+            ids.discard(id)
+            if not ids:
+                del self.cells[cell]
+        for cell in newCells - oldCells:
+            self.cells.setdefault(cell, set()).add(id)
+
+    def remove(self, id):
+        box = self.boxes.pop(id, None)
+        if box is None:
+            return
+        for cell in self.cellRange(box):
+            ids = self.cells.get(cell)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.boxes.clear()
+
+    def hit(self, x, y):
+        #   Topmost (highest id) box containing the point, None when there is none
+        top = None
+        for id in self.cells.get((int(x) // self.cellSize, int(y) // self.cellSize), ()):
+            x1, y1, x2, y2 = self.boxes[id]
+            if x1 <= x <= x2 and y1 <= y <= y2 and (top is None or id > top):
+                top = id
+        return top
+
+    def query(self, bbox):
+        #   Ids of the boxes overlapping bbox
+        x1, y1, x2, y2 = box = self.normalize(bbox)
+        found = set()
+        for cell in self.cellRange(box):
+            for id in self.cells.get(cell, ()):
+                bx1, by1, bx2, by2 = self.boxes[id]
+                if bx1 <= x2 and x1 <= bx2 and by1 <= y2 and y1 <= by2:
+                    found.add(id)
+        return found
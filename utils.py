@@ -1,9 +1,9 @@
 # Utility functions (e.g., windowing toold, file handling, conversions)
 
-from PyQt6.QtCore import QPoint, QSize, Qt, pyqtSignal
+import numpy as np
+from PyQt6.QtCore import QPoint, QPointF, QSize, Qt, pyqtSignal
 from PyQt6.QtWidgets import QWidget
-from PyQt6.QtGui import QMouseEvent, QPainter, QPen, QColor, QFontMetrics, QWheelEvent
-from numpy import who
+from PyQt6.QtGui import QMouseEvent, QPainter, QPen, QColor, QFontMetrics, QWheelEvent, QPolygonF
 
 #   Custom Windowing Slider
 
@@ -48,11 +48,25 @@ class WindowingSlider(QWidget):
         self.wcField = 0
         self.wwField = 0
 
+        #   Image histogram drawn behind the bars, log scaled heights in [0, 1]
+        self.histogramLevels = None
+        self.histogramColor = '#4a4f59'
+
         self.setMinimumSize(200, 70)
 
     def sizeHint(self):
         return QSize(300, 70)
 
+    def setHistogram(self, counts, points=128):
+        #   Counts come from the loader's cached histogram, only a few summed points are kept
+        if counts is None or len(counts) == 0:
+            self.histogramLevels = None
+        else:
+            groups = np.array_split(np.asarray(counts, dtype=np.float64), min(points, len(counts)))
+            levels = np.log1p([group.sum() for group in groups])
+            self.histogramLevels = (levels / max(levels.max(), 1e-9)).tolist()
+        self.update()
+
     #   Background Bar
 
     def paintEvent(self, event):
@@ -63,6 +77,17 @@ class WindowingSlider(QWidget):
         #   Background
         #painter.fillRect(self.rect(), QColor(self.bgColor),)
 
+        #   Histogram
+        if self.histogramLevels:
+            baseY = self.height() // 2
+            step = (self.width() - 20) / max(len(self.histogramLevels) - 1, 1)
+            outline = [QPointF(10, baseY)]
+            outline += [QPointF(10 + i * step, baseY - level * 25) for i, level in enumerate(self.histogramLevels)]
+            outline.append(QPointF(self.width() - 10, baseY))
+            painter.setPen(Qt.PenStyle.NoPen)
+            painter.setBrush(QColor(self.histogramColor))
+            painter.drawPolygon(QPolygonF(outline))
+
         #   Background bar
         bgPen = QPen(QColor(self.bgBarColor))
         bgPen.setWidth(2)
@@ -105,8 +130,17 @@ class WindowingSlider(QWidget):
                 self.update()
 
 
+    def mouseMoveEvent(self, event: QMouseEvent):
+        #   Dragging the knob, the main window renders previews until the input settles
+        if event.buttons() & Qt.MouseButton.LeftButton:
+            newX = event.position().x()
+            if self.halfWidth <= newX < self.width() - self.halfWidth:
+                self.knobX = newX
+                if self.imageLoaded:
+                    self.updateKnobLocation(newX = newX)
+                self.update()
+
     def updateKnobLocation(self, newX):
-        print('----------------------',newX, self.transRatio)
         self.newWc = (newX * self.transRatio) + self.fltMin
         if self.newWc >= self.avg:
             self.newWc = (newX * self.transRatio) + self.fltMin + 100
@@ -131,7 +165,6 @@ class WindowingSlider(QWidget):
         #   converts writtenwc to x location for knob -> it returns self.knobX
         self.stringZero = str(self.wcField)
         newKnobX = ((self.wcField - 100 - self.fltMin) // self.transRatio) + 25
-        print('new knobx: ', newKnobX)
         self.knobX = newKnobX
         if self.knobX > 272:
             self.knobX = 262